@@ -19,7 +19,7 @@ PYTHON_REQUIRES = ">=3.6"
 
 INSTALL_REQUIRES = [
 
-    'csvObject', 'shapeObject', 'shapely', 'miscSupports', 'numpy']
+    'csvObject', 'shapeObject', 'shapely>=2.0', 'miscSupports', 'numpy', 'scipy']
 
 CLASSIFIERS = [
     'Programming Language :: Python :: 3.7',
@@ -1,3 +1,5 @@
+from weightGIS.weighting.StreamWeights import is_streamed, iterate_weights
+
 from miscSupports import flatten, terminal_time, load_json, validate_path
 from csvObject import write_csv
 from typing import List, Union
@@ -7,7 +9,8 @@ from pathlib import Path
 class FormatAsCsv:
     def __init__(self, database_path: [Path, str]):
         print("...Loading")
-        self.database = load_json(validate_path(database_path))
+        database_path = validate_path(database_path)
+        self.database = dict(iterate_weights(database_path)) if is_streamed(database_path) else load_json(database_path)
 
         self._attrs = self._set_headers()
         self._dates = self._set_unique_dates()
@@ -1,3 +1,4 @@
+from weightGIS.weighting.StreamWeights import write_weights_line
 from weightGIS.Cleaning import FormatStandardise
 
 from miscSupports import write_json, load_json, terminal_time, validate_path
@@ -6,20 +7,39 @@ from pathlib import Path
 
 
 class FormatRelational:
-    def __init__(self, matcher: FormatStandardise, data_name: str, write_directory: Union[Path, str]):
+    def __init__(self, matcher: FormatStandardise, data_name: str, write_directory: Union[Path, str],
+                 stream: bool = False):
 
         self._std = matcher
         self._data_name = data_name
         self._write_directory = write_directory
+        self._stream = stream
 
         self._database = load_json(validate_path(Path(write_directory, f"Cleaned_{data_name}.txt")))
         self.reformatted_database = {}
 
     def __call__(self):
         """
-        Create a json file for place that contains all the information across time from the standardised data
+        Create a json file for place that contains all the information across time from the standardised data.
+
+        If streaming, each place is written as a line of a .jsonl file as soon as it is formatted rather than held
+        until every place is, which WeightExternal can then read a batch of places at a time.
         """
+        if self._stream:
+            with open(Path(self._write_directory, f"Relational_{self._data_name}.jsonl"), "w",
+                      encoding="utf-8") as relational_file:
+                for place_name, place_data in self._format_places():
+                    write_weights_line(relational_file, place_name, place_data)
+
+        else:
+            for place_name, place_data in self._format_places():
+                self.reformatted_database[place_name] = place_data
+            write_json(self.reformatted_database, self._write_directory, f"Relational_{self._data_name}")
+
+        print(f"Finished at {terminal_time()}")
 
+    def _format_places(self):
+        """Yield each place's name and the information across time relating to it"""
         for call_index, place in enumerate(self._std.matcher.values(), 1):
             if call_index % 100 == 0:
                 print(f"{call_index} / {len(self._std.matcher.values())}")
@@ -31,10 +51,7 @@ class FormatRelational:
             for date in self._database:
                 self._process_relation_data(date, place.name, place_data)
 
-            self.reformatted_database[place.name] = place_data
-
-        write_json(self.reformatted_database, self._write_directory, f"Relational_{self._data_name}")
-        print(f"Finished at {terminal_time()}")
+            yield place.name, place_data
 
     def _process_relation_data(self, date: str, place: str, place_data: dict) -> None:
         """
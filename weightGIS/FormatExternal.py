@@ -1,11 +1,14 @@
 from weightGIS.Cleaning import FormatAsCsv, FormatCombine, FormatLink, FormatNames, FormatPartitions, \
     FormatRelational, FormatStandardise
 
+from weightGIS.weighting.StreamRelational import write_streamed_relational
+from weightGIS.weighting.StreamWeights import is_streamed
 from weightGIS import WeightExternal
 
 from miscSupports import directory_iterator
 from typing import Optional, Union, List
 from pathlib import Path
+import os
 
 
 class FormatExternal:
@@ -39,13 +42,79 @@ class FormatExternal:
         """Link a cleaned file based on its unique ID to the full name and then construct the database"""
         FormatLink(self._matcher, corrections)(data_directory, self._write_directory, self.data_name)
 
-    def relational_database(self) -> None:
-        """Reformat Cleaned database of Date: Place: Attribute: Value -> Place: Attribute: Date: Value """
-        FormatRelational(self._matcher, self.data_name, self._write_directory)()
+    def relational_database(self, stream: bool = False) -> None:
+        """
+        Reformat Cleaned database of Date: Place: Attribute: Value -> Place: Attribute: Date: Value, written a place per
+        line if stream
+        """
+        FormatRelational(self._matcher, self.data_name, self._write_directory, stream)()
 
-    def weight_database(self, weights_path, date_max):
-        WeightExternal(Path(self._write_directory, f"Relational_{self.data_name}.txt"), weights_path, date_max
-                       ).weight_external(self._write_directory, f"{self.data_name}_Weighted")
+    def weight_database(self, weights_path, date_max, stream_output: bool = False):
+        """
+        Weight the relational database, reading it a batch of places at a time if it was streamed. The weighted
+        database is written as a json, or a place per line if stream_output and the relational database was streamed
+        """
+        WeightExternal(self._relational_path(self.data_name), weights_path, date_max).weight_external(
+            self._write_directory, f"{self.data_name}_Weighted", stream_output=stream_output)
+
+    def weight_databases(self, data_names: List[str], weights_path, date_max, stream_output: bool = False):
+        """
+        Weight the relational databases of each of data_names within the write directory against the same weights, in
+        a single walk of their weight plan. See WeightExternal.weight_streams.
+
+        :param data_names: The names of the relational databases to weight. Each is read a batch of places at a time,
+            so databases written as a json are first rewritten a place per line to a temporary .jsonl, one at a time,
+            so that only one is ever loaded whole
+        :type data_names: list[str]
+
+        :param weights_path: The weights by dates json, or weight plan, to weight every database against
+        :type weights_path: Path | str | ColumnarWeights
+
+        :param date_max: The end date for weighting
+        :type date_max: int
+
+        :param stream_output: Write each weighted database a place per line as a .jsonl rather than as a json
+        :type stream_output: bool
+
+        :return: Nothing, write each weighted database, and its non common dates, to the write directory then stop
+        :rtype: None
+        """
+        weight_plan = WeightExternal.weight_plan(weights_path)
+        relational_paths = [self._relational_path(data_name) for data_name in data_names]
+        streamed_paths = [path if is_streamed(path) else path.with_name(f"{path.stem}.{os.getpid()}.tmp.jsonl")
+                          for path in relational_paths]
+
+        try:
+            for relational_path, streamed_path in zip(relational_paths, streamed_paths):
+                if streamed_path != relational_path:
+                    print(f"Streaming {relational_path.name} so it can be weighted alongside the other databases")
+                    write_streamed_relational(relational_path, streamed_path)
+
+            WeightExternal.weight_streams(
+                [WeightExternal(streamed_path, weight_plan, date_max) for streamed_path in streamed_paths],
+                self._write_directory, [f"{data_name}_Weighted" for data_name in data_names],
+                stream_output=stream_output)
+
+        finally:
+            for relational_path, streamed_path in zip(relational_paths, streamed_paths):
+                if streamed_path != relational_path:
+                    streamed_path.unlink(missing_ok=True)
+
+    def _relational_path(self, data_name: str) -> Path:
+        """
+        The relational database of data_name, streamed to a .jsonl or written as a .txt json. If relational_database has
+        written both then the most recently written is used, with a warning that the other is being ignored.
+        """
+        streamed_path = Path(self._write_directory, f"Relational_{data_name}.jsonl")
+        json_path = streamed_path.with_suffix(".txt")
+        if not (streamed_path.exists() and json_path.exists()):
+            return streamed_path if streamed_path.exists() else json_path
+
+        relational_path, ignored_path = sorted([streamed_path, json_path], key=lambda path: path.stat().st_mtime_ns,
+                                               reverse=True)
+        print(f"Warning: Found both {streamed_path.name} and {json_path.name} for {data_name}\n"
+              f"       : Weighting the most recently written {relational_path.name} and ignoring {ignored_path.name}")
+        return relational_path
 
     @staticmethod
     def combine_data_sources(unique_id, data_start, data_directory, write_directory, date):
@@ -59,5 +128,11 @@ class FormatExternal:
                          merged_list, population, self._splitter, file_index, name_index)()
 
     def as_csv(self, database_name: str, output_dir: Union[Path, str], write_name: str):
-        """Format the database as a csv for statistical software or uses not used to using database structures"""
-        FormatAsCsv(Path(self._write_directory, f"{database_name}.txt"))(output_dir, write_name)
+        """
+        Format the database as a csv for statistical software or uses not used to using database structures. A database
+        written a place per line, as {database_name}.jsonl, is read if there is no json of it.
+        """
+        database_path = Path(self._write_directory, f"{database_name}.txt")
+        if not database_path.exists() and database_path.with_suffix(".jsonl").exists():
+            database_path = database_path.with_suffix(".jsonl")
+        FormatAsCsv(database_path)(output_dir, write_name)
@@ -1,7 +1,12 @@
+from weightGIS.Parallel import chunk_indexes, parallel_map
+from weightGIS.Overlaps import indexed_overlaps
+from weightGIS.ShapeIndex import ShapeIndex
+
 from miscSupports import flatten, meters_to_km_miles, terminal_time
-from shapeObject import ShapeObject
+from shapely import from_wkb, to_wkb
 from csvObject import write_csv
 from pathlib import Path
+import numpy as np
 
 
 class GeoLookup:
@@ -17,17 +22,24 @@ class GeoLookup:
 
         self._place_data = []
 
-    def construct_lookup(self, write_directory, write_name):
+    def construct_lookup(self, write_directory, write_name, workers=1):
         """
         This will construct a geo-relation csv from a base shapefile relative to a list of other shapefiles based on
         intersection of geometry. For this to work your base shapefile must be the lowest level, otherwise you will end
         up with large levels of ambiguity
 
+        The largest overlap of every base shape within each level is found from that level's index, with the overlaps
+        of a chunk of base shapes calculated at once. If workers is greater than one, the chunks are processed
+        across a pool of that many processes.
+
         :param write_directory: Where to save this csv
         :param write_name: What to call this csv
+        :param workers: The number of processes to find the largest overlaps across, defaults to one
         :return: Nothing, write file then stop
         :rtype: None
         """
+        level_matches = self._level_matches(workers)
+
         for i, (place, record) in enumerate(zip(self.base.polygons, self.base.records)):
             if i % 100 == 0:
                 print(f"{i}/{len(self.base.records)}")
@@ -35,9 +47,9 @@ class GeoLookup:
             # Set the place records via the first index as well as the area for the lowest order shape
             name_base = self._index_record(record, self.base_index, place)
 
-            # Then do the same for all the other shapes that intersect with this shape
-            match_names = [self._find_matches(place, match_shape, indexes)
-                           for match_shape, indexes in zip(self.others, self.other_indexes)]
+            # Then do the same for the largest of the other shapes that intersect with this shape
+            match_names = [self._match_name(match_shape, indexes, matches[i])
+                           for match_shape, indexes, matches in zip(self.others, self.other_indexes, level_matches)]
 
             self._place_data.append(flatten([name_base] + match_names))
 
@@ -51,19 +63,60 @@ class GeoLookup:
         """
         return [rec for i, rec in enumerate(record) if i in indexes] + meters_to_km_miles(location.area)
 
-    def _find_matches(self, place, match_shape, indexes):
+    def _level_matches(self, workers):
+        """
+        Find the index of the largest overlapping shape of each level for every base shape, or -1 if a base shape does
+        not intersect that level. The base shapes are split into chunks, whose matches within every level are found at
+        once. If workers is greater than one the chunks are processed across a pool of processes, which are each sent
+        the level indexes once and then only the WKB of each chunk's base shapes.
+        """
+        base_length = len(self.base.polygons)
+        chunks = chunk_indexes(range(base_length), workers)
+
+        if workers > 1 and len(chunks) > 0:
+            tasks = [(to_wkb(self.base.polygons[list(chunk)]),) for chunk in chunks]
+            chunk_matches = parallel_map(self.others, _chunk_largest_overlaps, tasks, workers)
+        else:
+            chunk_matches = ([self._largest_overlaps(self.base.polygons[list(chunk)], level) for level in self.others]
+                             for chunk in chunks)
+
+        level_matches = [[] for _ in self.others]
+        for chunk, matches in zip(chunks, chunk_matches):
+            print(f"Matched {chunk[-1] + 1}/{base_length} to every level")
+            for level, level_match in zip(level_matches, matches):
+                level.extend(level_match)
+        return level_matches
+
+    @staticmethod
+    def _largest_overlaps(polygons, level):
         """
-        If a place finds an intersection with a match place, append the name to the area in a dictionary. Then, assuming
-        at least one match is found, return the largest match. If nothing is found, return Failed.
+        Find the largest overlapping shape of the level for each of the base polygons, in a single indexed and
+        vectorised pass. When two shapes overlap a base shape by exactly the same area, the one that comes first in the
+        level's records is kept, so the result never depends on the order overlaps are found in.
+
+        :return: The index of the largest match of each base shape, or -1 if it does not intersect the level
+        :rtype: list[int]
         """
-        overlap_dict = {}
-        for match, rec in zip(match_shape.polygons, match_shape.records):
-            overlap = place.intersection(match).area
-            if overlap > 0:
-                overlap_dict[overlap] = self._index_record(rec, indexes, match)
-
-        if len(overlap_dict.keys()) > 0:
-            return overlap_dict[max(overlap_dict.keys())]
+        base_indexes, match_indexes, overlap_areas = indexed_overlaps(polygons, level)
+        base_indexes = np.array(base_indexes, dtype=np.int64)
+        match_indexes = np.array(match_indexes, dtype=np.int64)
+
+        # Order each base shape's overlaps by largest area, then by record, and keep the first
+        order = np.lexsort((match_indexes, -np.array(overlap_areas, dtype=np.float64), base_indexes))
+        base_indexes, match_indexes = base_indexes[order], match_indexes[order]
+        largest = np.ones(len(order), dtype=bool)
+        largest[1:] = base_indexes[1:] != base_indexes[:-1]
+
+        matches = np.full(len(polygons), -1, dtype=np.int64)
+        matches[base_indexes[largest]] = match_indexes[largest]
+        return matches.tolist()
+
+    def _match_name(self, match_shape, indexes, match_index):
+        """
+        Return the records and area of the largest match of a place. If nothing is found, return Failed.
+        """
+        if match_index >= 0:
+            return self._index_record(match_shape.records[match_index], indexes, match_shape.polygons[match_index])
         else:
             # If we fail we need to have the number of index + 2 because of the two area variables produced
             return ["Failed" for _ in range(len(indexes) + 2)]
@@ -83,11 +136,17 @@ class GeoLookup:
         assert self._header_len == len(headers), f"{len(headers)} headers provided yet expected {self._header_len}"
 
         print("Loading Shapefiles into memory...")
-        base = ShapeObject(base_path)
-        others = [ShapeObject(shapefile_path) for shapefile_path in other_shapefiles]
+        base = ShapeIndex.from_shapefile(base_path)
+        others = [ShapeIndex.from_shapefile(shapefile_path) for shapefile_path in other_shapefiles]
         return base, others, headers
 
     @property
     def _header_len(self):
         """Target Length for headers"""
         return len(flatten(self._indexes)) + len(self._indexes) * 2
+
+
+def _chunk_largest_overlaps(levels, wkb):
+    """Find the largest overlaps within every level of a chunk of base shapes, sent as WKB, within a worker process"""
+    polygons = from_wkb(wkb)
+    return [GeoLookup._largest_overlaps(polygons, level) for level in levels]
@@ -1,8 +1,113 @@
+from weightGIS.Parallel import parallel_map
+from weightGIS.ShapeIndex import ShapeIndex
+
+from shapely import contains, points, prepare
 from csvObject import CsvObject, write_csv
 from miscSupports import validate_path
-from shapeObject import ShapeObject
 from shapely.geometry import Point
+from itertools import islice
+from collections import deque
 from pathlib import Path
+import numpy as np
+import csv
+
+
+class PointLocator:
+    def __init__(self, shapefile, match_index):
+        """
+        Locates points within the polygons of a shapefile, returning the record at match_index of the polygon they are
+        within, or of the nearest polygon if they are not within any.
+
+        The polygons are prepared and searched via the shapefile's tree, so only the polygons whose bounding box
+        contains a point are tested for containing it and the nearest polygon is found via a nearest neighbour query
+        rather than the distance to every polygon.
+
+        :param shapefile: The indexed shapefile to locate points within
+        :type shapefile: ShapeIndex
+
+        :param match_index: The index of the record to return for the polygon a point is located in
+        :type match_index: int
+        """
+        self._shapefile = shapefile
+        self._match_index = match_index
+        self._polygons = shapefile.polygons
+        self._tree = shapefile.tree
+        self._match_values = [record[match_index] for record in shapefile.records]
+        prepare(self._polygons)
+
+    def __getstate__(self):
+        """Ship the shapefile, as WKB via ShapeIndex, so each process prepares its polygons itself"""
+        return {"shapefile": self._shapefile, "match_index": self._match_index}
+
+    def __setstate__(self, state):
+        self.__init__(state["shapefile"], state["match_index"])
+
+    def locate(self, point):
+        """
+        Locate a point, returning the match record of the first polygon in record order that contains it. If no polygon
+        contains it, return the match record of the nearest polygon, with ties broken on the lowest match record.
+
+        :param point: A shapely Point from the eastings and northings
+        :type point: Point
+
+        :return: A match record from the shapefile, as a string, or None as a string if nothing could be matched
+        :rtype: str
+        """
+        candidates = self._tree.query(point)
+        candidates.sort()
+        within = candidates[contains(self._polygons[candidates], point)]
+        if len(within) > 0:
+            return str(self._match_values[within[0]])
+
+        nearest, distances = self._tree.query_nearest(point, all_matches=True, return_distance=True)
+        if len(nearest) == 0:
+            return "None"
+        return str(min(zip(distances.tolist(), [self._match_values[i] for i in nearest]))[1])
+
+    def locate_many(self, eastings, northings):
+        """
+        Locate an array of points at once, with the same result for each point as locate.
+
+        All the points are tested against the tree in a single vectorised query. Where a point is within multiple
+        polygons the first in record order is kept, and any points that are not within a polygon are then matched to
+        their nearest polygon via a single nearest neighbour query.
+
+        :param eastings: The eastings of the points
+        :type eastings: np.ndarray
+
+        :param northings: The northings of the points
+        :type northings: np.ndarray
+
+        :return: An array of the match record, as a string, for each point
+        :rtype: np.ndarray
+        """
+        located = np.full(len(eastings), "None", dtype=object)
+        point_array = points(eastings, northings)
+        match_values = np.array([str(value) for value in self._match_values], dtype=object)
+
+        # Keep the lowest polygon index of each point that is within a polygon
+        point_indexes, polygon_indexes = self._tree.query(point_array, predicate="within")
+        order = np.lexsort((polygon_indexes, point_indexes))
+        point_indexes, first = np.unique(point_indexes[order], return_index=True)
+        located[point_indexes] = match_values[polygon_indexes[order][first]]
+
+        # Points not within any polygon are assigned the nearest, with ties broken on the lowest match record
+        missed = np.setdiff1d(np.arange(len(eastings)), point_indexes)
+        if len(missed) > 0:
+            (missed_indexes, nearest), distances = self._tree.query_nearest(
+                point_array[missed], all_matches=True, return_distance=True)
+
+            closest = {}
+            for missed_index, polygon_index, distance in zip(missed_indexes.tolist(), nearest.tolist(),
+                                                             distances.tolist()):
+                candidate = (distance, self._match_values[polygon_index])
+                if missed_index not in closest or candidate < closest[missed_index]:
+                    closest[missed_index] = candidate
+
+            for missed_index, (_, match_value) in closest.items():
+                located[missed[missed_index]] = str(match_value)
+
+        return located
 
 
 class IDLocate:
@@ -32,15 +137,24 @@ class IDLocate:
         :type write_name: str
         """
 
-        self.id_file = CsvObject(id_path)
-        self.shapefile = ShapeObject(shapefile_path)
+        self.id_path = Path(id_path)
+        self._id_file = None
+        self.shapefile = ShapeIndex.from_shapefile(shapefile_path)
         self.east_i = east_i
         self.north_i = north_i
         self.shape_match_index = shape_match_i
+        self.locator = PointLocator(self.shapefile, self.shape_match_index)
         self.write_directory = validate_path(write_directory)
         self.write_name = write_name
 
-    def geo_ref_locate_individuals(self, geo_lookup):
+    @property
+    def id_file(self):
+        """The id file is only loaded when first required, so that streaming never holds all of it in memory"""
+        if self._id_file is None:
+            self._id_file = CsvObject(self.id_path)
+        return self._id_file
+
+    def geo_ref_locate_individuals(self, geo_lookup, bulk=False):
         """
         This will assist you locating individuals with a geo lookup, so a single low level shapefile can identify all
         levels within a single loop
@@ -48,6 +162,9 @@ class IDLocate:
         :param geo_lookup: The path to the geo lookup
         :type geo_lookup: Path | str
 
+        :param bulk: If True, locate all the unique places in a single vectorised pass rather than one at a time
+        :type bulk: bool
+
         :return: Nothing, write the file then stop
         :rtype: None
         """
@@ -56,13 +173,18 @@ class IDLocate:
         # Create an id: all other rows lookup so we can identify each location from the lowest
         geo_lookup = {row[self.shape_match_index]: row for row in geo_file.row_data}
 
-        # Link all the geometry
-        geo_link = self._create_geo_link(geo_file, geo_lookup)
-
-        # create the headers for the file, then write the located out
+        # create the headers for the file
         headers = [h for i, h in enumerate(self.id_file.headers) if i not in (self.east_i, self.north_i)] + \
             geo_file.headers
-        self._write_located(geo_link, headers)
+
+        if bulk:
+            located = [_geo_row(location_id, geo_lookup, geo_file.row_length) for location_id in self._bulk_locate()]
+            self._write_located(located, headers)
+
+        else:
+            # Link all the geometry, then write the located out
+            geo_link = self._create_geo_link(geo_file, geo_lookup)
+            self._write_located(self._linked_rows(geo_link), headers)
 
     def _create_geo_link(self, geo_file, geo_lookup):
         """
@@ -118,54 +240,161 @@ class IDLocate:
         :type point: Point
 
         :return: A match record from the shapefile that was returned
-        :rtype:
+        :rtype: str
         """
-        for shape, record in zip(self.shapefile.polygons, self.shapefile.records):
-            if shape.contains(point):
-                return str(record[self.shape_match_index])
+        return self.locator.locate(point)
 
-        # If we fail to find the location within, create a list of all the distances
-        lowest_list = [[point.distance(shape), record[self.shape_match_index]] for shape, record in zip(
-            self.shapefile.polygons, self.shapefile.records)]
+    def _bulk_locate(self):
+        """
+        Locate every respondent in a single vectorised pass. Respondents are reduced to their unique coordinates, which
+        are located all at once, and the results mapped back to each respondent.
 
-        # Return the smallest distance of the sorted list [0] record [1] if we find anything. Else Return str of None
-        try:
-            return str(sorted(lowest_list)[0][1])
-        except KeyError:
-            return "None"
+        :return: The match record, as a string, of each respondent in row order, or None where a respondent has no or
+            invalid coordinates
+        :rtype: list
+        """
+        eastings = [row[self.east_i] for row in self.id_file.row_data]
+        northings = [row[self.north_i] for row in self.id_file.row_data]
+        return _locate_coordinates(self.locator, eastings, northings)
 
-    def _write_located(self, geo_link, headers):
+    def _linked_rows(self, geo_link):
+        """Isolate the unique linker entry of each respondent in row order"""
+        return [geo_link[f"{respondent[self.east_i]}__{respondent[self.north_i]}"]
+                for respondent in self.id_file.row_data]
+
+    def _write_located(self, located, headers):
         """
-        Using the unique linker, write the located individuals to a csv file
+        Using the located details of each respondent, write the located individuals to a csv file
 
         :param headers: Headers of the csv file
         :type headers: list[str]
 
-        :param geo_link: The unique dict of {Unique_place: details of that place}
-        :type geo_link: dict
+        :param located: The details of the place of each respondent, in the same order as the respondents
+        :type located: list[list]
 
         :return: Nothing, write the file out to the write directory, called write_name, then stop
         :rtype: None
         """
         output_rows = []
-        for respondent in self.id_file.row_data:
+        for respondent, birth_location in zip(self.id_file.row_data, located):
             # Isolate the rows that are not east/north
             non_location = [r for i, r in enumerate(respondent) if i not in (self.east_i, self.north_i)]
 
-            # Prepend this along with the geo_link birth location
-            birth_location = f"{respondent[self.east_i]}__{respondent[self.north_i]}"
-            output_rows.append(non_location + geo_link[birth_location])
+            # Prepend this along with the birth location
+            output_rows.append(non_location + birth_location)
 
         write_csv(self.write_directory, self.write_name, headers, output_rows)
 
-    def locate_individuals(self):
+    def locate_individuals(self, bulk=False):
         """
         This will locate individuals within a single shapefile
 
+        :param bulk: If True, locate all the unique places in a single vectorised pass rather than one at a time
+        :type bulk: bool
+
         :return: Nothing, write the file out to the write directory, called write_name, then stop
         :rtype: None
         """
-        self._write_located(self._link_unique(), ["ID", "GID"])
+        if bulk:
+            located = [["No or invalid coordinates"] if location_id is None else [location_id]
+                       for location_id in self._bulk_locate()]
+            self._write_located(located, ["ID", "GID"])
+        else:
+            self._write_located(self._linked_rows(self._link_unique()), ["ID", "GID"])
+
+    def stream_locate_individuals(self, geo_lookup=None, chunk_size=100000, workers=1):
+        """
+        Locate individuals from an id file too large to hold in memory. The id file is read in chunks of chunk_size
+        rows, each chunk is located in a single vectorised pass, and its rows appended to the output file before the
+        next chunk is read.
+
+        With more than one worker the chunks are located across a pool of processes, which are each sent the
+        shapefile once. Only a bounded window of chunks is ever in flight, and chunks are written in the order they
+        were read, so the output is the same as with a single worker.
+
+        :param geo_lookup: The path to a geo lookup to link each located place to, or None to only write the GID
+        :type geo_lookup: Path | str | None
+
+        :param chunk_size: The number of rows of the id file to locate at once
+        :type chunk_size: int
+
+        :param workers: The number of processes to locate chunks across
+        :type workers: int
+
+        :return: Nothing, write the file out to the write directory, called write_name, then stop
+        :rtype: None
+        """
+        with open(self.id_path, "rt", encoding="utf-8-sig") as id_file, \
+                open(f"{self.write_directory}/{self.write_name}.csv", "w", newline="", encoding="utf-8") as out_file:
+            id_reader = csv.reader(id_file)
+            id_headers = next(id_reader)
+            id_headers = [header if header != "" else f"Untitled_{index + 1}"
+                          for index, header in enumerate(id_headers)]
+
+            if geo_lookup:
+                geo_file = CsvObject(geo_lookup)
+                geo_lookup = {row[self.shape_match_index]: row for row in geo_file.row_data}
+                location_headers = geo_file.headers
+            else:
+                location_headers = ["GID"]
+
+            csv_writer = csv.writer(out_file)
+            csv_writer.writerow(
+                [h for i, h in enumerate(id_headers) if i not in (self.east_i, self.north_i)] + location_headers)
+
+            written = 0
+            located_chunks = self._locate_chunks(self._id_chunks(id_reader, len(id_headers), chunk_size), workers)
+            for chunk_index, (chunk, location_ids) in enumerate(located_chunks):
+                if chunk_index % 100 == 0:
+                    print(f"Located {written} respondents")
+
+                for respondent, location_id in zip(chunk, location_ids):
+                    if geo_lookup:
+                        location = _geo_row(location_id, geo_lookup, geo_file.row_length)
+                    else:
+                        location = ["No or invalid coordinates"] if location_id is None else [location_id]
+
+                    csv_writer.writerow(
+                        [r for i, r in enumerate(respondent) if i not in (self.east_i, self.north_i)] + location)
+
+                written += len(chunk)
+            print(f"Located {written} respondents")
+
+    @staticmethod
+    def _id_chunks(id_reader, row_length, chunk_size):
+        """Yield the rows of the id file in lists of chunk_size, padding short rows in the same way as CsvObject"""
+        while True:
+            chunk = [row + ["" for _ in range(row_length - len(row))] for row in islice(id_reader, chunk_size)]
+            if not chunk:
+                return
+            yield chunk
+
+    def _locate_chunks(self, chunks, workers):
+        """
+        Yield each chunk of id rows alongside the location of each of its rows, in the order the chunks were read.
+
+        With more than one worker, the locator is shipped to each process once and at most two chunks per worker are
+        submitted ahead of the chunk being yielded, so that memory stays bounded however large the id file is.
+        """
+        if workers <= 1:
+            for chunk in chunks:
+                yield chunk, _locate_coordinates(self.locator, *self._chunk_coordinates(chunk))
+            return
+
+        # Chunks are held until they are located, which is never more than the chunks parallel_map has in flight
+        in_flight = deque()
+
+        def tasks():
+            for chunk in chunks:
+                in_flight.append(chunk)
+                yield self._chunk_coordinates(chunk)
+
+        for location_ids in parallel_map(self.locator, _locate_coordinates, tasks(), workers):
+            yield in_flight.popleft(), location_ids
+
+    def _chunk_coordinates(self, chunk):
+        """The eastings and northings of a chunk of id rows"""
+        return [row[self.east_i] for row in chunk], [row[self.north_i] for row in chunk]
 
     def _link_unique(self):
         """
@@ -195,3 +424,49 @@ class IDLocate:
                 geo_link[coordinate] = [self._point_identification(point)]
 
         return geo_link
+
+
+def _locate_coordinates(locator, eastings, northings):
+    """
+    Locate a set of respondents from their eastings and northings. Respondents are reduced to their unique coordinates,
+    which are located in a single vectorised pass, and the results mapped back to each respondent.
+
+    :param locator: The locator of the shapefile to locate the respondents within
+    :type locator: PointLocator
+
+    :param eastings: The easting of each respondent, as read from the id file
+    :type eastings: list
+
+    :param northings: The northing of each respondent, as read from the id file
+    :type northings: list
+
+    :return: The match record, as a string, of each respondent in order, or None where a respondent has no or invalid
+        coordinates
+    :rtype: list
+    """
+    eastings = np.array([str(east) for east in eastings], dtype=object)
+    northings = np.array([str(north) for north in northings], dtype=object)
+
+    located = np.full(len(eastings), None, dtype=object)
+    valid = (np.char.str_len(eastings.astype(str)) > 0) & (np.char.str_len(northings.astype(str)) > 0)
+    if not valid.any():
+        return located.tolist()
+
+    coordinates = np.column_stack((eastings[valid].astype(float), northings[valid].astype(float)))
+    unique_coordinates, respondent_places = np.unique(coordinates, axis=0, return_inverse=True)
+
+    places = locator.locate_many(unique_coordinates[:, 0], unique_coordinates[:, 1])
+    located[valid] = places[respondent_places.reshape(-1)]
+    return located.tolist()
+
+
+def _geo_row(location_id, geo_lookup, row_length):
+    """Return the geo lookup row of a located place, or a row explaining why it could not be linked"""
+    if location_id is None:
+        return ["No or invalid coordinates" for _ in range(row_length)]
+    elif location_id in geo_lookup:
+        return geo_lookup[location_id]
+    else:
+        print(f"Failed to find {location_id}")
+        return ["ID not found in geolookup" for _ in range(row_length)]
+
@@ -0,0 +1,32 @@
+from weightGIS.ShapeIndex import ShapeIndex
+
+from shapely.geometry import Polygon, MultiPolygon
+from shapely import area, intersection
+from typing import List, Sequence, Tuple, Union
+import numpy as np
+
+
+def overlap_areas(base_geometry: np.ndarray, match_geometry: np.ndarray, pairs: np.ndarray) -> np.ndarray:
+    """
+    Calculate the area of intersection for each [base index, match index] pair within a 2 x N array of pairs, in a
+    single vectorised call rather than a python level intersection per pair
+    """
+    return area(intersection(base_geometry[pairs[0]], match_geometry[pairs[1]]))
+
+
+def indexed_overlaps(base_geometry: Union[Polygon, MultiPolygon, Sequence, np.ndarray], match_index: ShapeIndex,
+                     cut_off: float = 0) -> Tuple[List[int], List[int], List[float]]:
+    """
+    Find the overlaps between the base geometry and the polygons of the match_index whose area is greater than the
+    cut_off.
+
+    Candidate pairs are taken from the match_index's tree, so only polygons with intersecting bounding boxes have their
+    intersection calculated. Returns the base indexes, match indexes and areas of each overlap, ordered by base index
+    then match index.
+    """
+    base_geometry = np.atleast_1d(base_geometry)
+    pairs = match_index.candidate_pairs(base_geometry)
+    areas = overlap_areas(base_geometry, match_index.polygons, pairs)
+
+    overlapping = areas > cut_off
+    return pairs[0][overlapping].tolist(), pairs[1][overlapping].tolist(), areas[overlapping].tolist()
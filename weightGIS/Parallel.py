@@ -0,0 +1,51 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, List, Sequence
+from collections import deque
+import multiprocessing
+import math
+
+
+def chunk_indexes(indexes: Sequence[int], workers: int) -> List[Sequence[int]]:
+    """
+    Split indexes into contiguous chunks, around eight per worker, so that work stays balanced across the workers
+    without each task being so small that sending it costs more than running it
+    """
+    chunk_size = max(1, math.ceil(len(indexes) / (max(workers, 1) * 8)))
+    return [indexes[i: i + chunk_size] for i in range(0, len(indexes), chunk_size)]
+
+
+def parallel_map(state: Any, function: Callable, tasks: Iterable[tuple], workers: int, fork: bool = False) -> Iterator:
+    """
+    Yield function(state, *task) for each of tasks, in the order of tasks, across a pool of workers processes.
+
+    The state is shipped to each process once, when it starts, and held for every task it runs, so each task only
+    sends the arguments that differ between tasks. If fork, the processes are forked so they share the state
+    copy-on-write rather than it being pickled. Tasks are only read as they are submitted, with at most two per worker
+    ahead of the result being yielded, so an iterator of tasks too large to hold in memory can be mapped.
+    """
+    context = multiprocessing.get_context("fork") if fork else None
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_initialise_worker,
+                             initargs=(state,)) as executor:
+        in_flight = deque()
+        for task in tasks:
+            in_flight.append(executor.submit(_run_task, function, task))
+            if len(in_flight) >= workers * 2:
+                yield in_flight.popleft().result()
+
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+# The state shipped to each process of a parallel_map
+_worker_state = None
+
+
+def _initialise_worker(state: Any) -> None:
+    """Hold the state shipped to this process so that each task only needs to send its own arguments"""
+    global _worker_state
+    _worker_state = state
+
+
+def _run_task(function: Callable, task: tuple) -> Any:
+    """Run a task against the state held by this worker process"""
+    return function(_worker_state, *task)
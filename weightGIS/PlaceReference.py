@@ -1,7 +1,9 @@
+from weightGIS.Parallel import parallel_map
+from weightGIS.Overlaps import indexed_overlaps
+from weightGIS.ShapeIndex import ShapeIndex
+
 from miscSupports import directory_iterator, flip_list, flatten
 from csvObject import CsvObject, write_csv
-from shapely.geometry import Polygon
-from shapeObject import ShapeObject
 from pathlib import Path
 import numpy as np
 import re
@@ -20,7 +22,7 @@ class PlaceReference:
         self._target_length = 2 + len(level_names)
         self._headers = [self._base_name] + self._level_names
 
-    def link_places_across_time(self, lowest_level, other_shapefile_levels, record_indexes, base_gid=0):
+    def link_places_across_time(self, lowest_level, other_shapefile_levels, record_indexes, base_gid=0, workers=1):
         """
         This will link to geo-levels together, files must have a numeric component and each sub_unit must be matched
         with a match-unit file with the same numeric component
@@ -44,6 +46,9 @@ class PlaceReference:
         :param base_gid: The gid index in the base shapefile, defaults to zero
         :type base_gid: int
 
+        :param workers: The number of processes to determine the overlaps of each year and level across, defaults to one
+        :type workers: int
+
         :return: Nothing, write the relations and ambiguity file is exists to file then stop.
         :rtype: None.
         """
@@ -56,16 +61,17 @@ class PlaceReference:
         base_indexes = record_indexes[0]
         other_level_indexes = record_indexes[1:]
 
+        # Determine the current year for each base unit, and the overlaps of each of its places within every level
+        years = [re.sub(r"[\D]", "", base_file.file_name) for base_file in base_shapefiles]
+        overlaps = self._year_level_overlaps(base_shapefiles, years, other_shapefiles, other_level_indexes, workers)
+
         ambiguous = []
-        for base_file in base_shapefiles:
+        for base_file, year, level_overlaps in zip(base_shapefiles, years, overlaps):
             print(f"\nProcessing {base_file}")
 
-            # Determine the current year for this base unit
-            year = re.sub(r"[\D]", "", base_file.file_name)
-
             # Determine the relations within this base file and set the headers of the output file
             relation_list, headers = self._determine_relations_to_base(
-                ambiguous, base_file, base_gid, base_indexes, other_level_indexes, other_shapefiles, year)
+                ambiguous, base_file, base_gid, base_indexes, level_overlaps, year)
 
             # Extract the base names from the first set of relations
             base_shape_names = [relation[:2] for relation in relation_list[0]]
@@ -115,21 +121,58 @@ class PlaceReference:
     @staticmethod
     def _load_shapefiles(path):
         """
-        Load the shapefiles into memory
+        Load the shapefiles into memory, from their geometry snapshots if valid, indexing each so overlaps can be
+        searched for
         """
-        return [ShapeObject(f"{path}/{file}") for file in directory_iterator(path) if Path(path, file).suffix == ".shp"]
+        return [ShapeIndex.from_shapefile(Path(path, file)) for file in directory_iterator(path)
+                if Path(path, file).suffix == ".shp"]
 
-    def _determine_relations_to_base(self, ambiguous, base_file, base_gid, base_indexes, level_indexes,
-                                     level_shapefiles, year):
+    def _year_level_overlaps(self, base_shapefiles, years, level_shapefiles, level_indexes, workers):
         """
-        For each level of shapefile use the year to load the shapefile of a given level relevant to the base_file and
-        then use this to look for matching relations. Standardise these relations in length, and then return them.
+        For each base shapefile, use its year to select the shapefile of each level relevant to it and determine the
+        names that overlap each of its places. Each (year, level) pair is independent of the others, so if workers is
+        greater than one they are determined concurrently across a pool of processes. The shapefiles are shipped to
+        each process once, when it starts, so each task only sends the position of its pair.
+
+        :param base_shapefiles: Base shapefiles for each year
+        :type base_shapefiles: list[ShapeIndex]
+
+        :param years: The year of each base shapefile
+        :type years: list[str]
+
+        :param level_shapefiles: A list levels, where each level contains a list of shapefiles
+        :type level_shapefiles: list[list[ShapeIndex]]
+
+        :param level_indexes: Indexes for constructing names for each level in other shapefiles
+        :type level_indexes: list[list[int]]
+
+        :param workers: The number of processes to use
+        :type workers: int
+
+        :return: For each base shapefile, a list of the overlaps of each level, from _level_overlaps
+        :rtype: list[list[list[list[str]]]]
+        """
+        pairs = [(base_file, self._set_match_file(level, year), indexes)
+                 for base_file, year in zip(base_shapefiles, years)
+                 for level, indexes in zip(level_shapefiles, level_indexes)]
+
+        if workers > 1:
+            overlaps = list(parallel_map((self, pairs), _pair_overlaps, [(i,) for i in range(len(pairs))], workers))
+        else:
+            overlaps = [self._level_overlaps(*pair) for pair in pairs]
+
+        return [overlaps[i: i + len(level_shapefiles)] for i in range(0, len(overlaps), len(level_shapefiles))]
+
+    def _determine_relations_to_base(self, ambiguous, base_file, base_gid, base_indexes, level_overlaps, year):
+        """
+        For each level of shapefile use the overlaps of the shapefile of that level relevant to the base_file to set the
+        matching relations. Standardise these relations in length, and then return them.
 
         :param ambiguous: Holder list for ambiguous relations
         :type ambiguous: list
 
         :param base_file: Base shapefile for the current 'year'
-        :type base_file: ShapeObject
+        :type base_file: ShapeIndex
 
         :param base_gid: Index for GID in base shape, defaults to zero in call method
         :type base_gid: int
@@ -137,14 +180,10 @@ class PlaceReference:
         :param base_indexes: Indexes for constructing the name from the base shapefile
         :type base_indexes: list[int]
 
-        :param level_indexes: Indexes for constructing names for each level in other shapefiles
-        :type level_indexes: list[list[int]]
-
-        :param level_shapefiles: A list levels, where each level contains a list of shapefiles we want to determine
-            relations of relative to this 'year'
-        :type level_shapefiles: list[list[ShapeObject]]
+        :param level_overlaps: For each level, the names of that level which overlap each place of the base_file
+        :type level_overlaps: list[list[list[str]]]
 
-        :param year: The year we wish to match to our lists of shapefiles to determine which one to load
+        :param year: The year of the base_file, written to ambiguous relations
         :type year: str | int
 
         :return: A list of standard length relations and the headers for the non base level part of the headers
@@ -152,14 +191,10 @@ class PlaceReference:
         """
         relation_list = []
         other_headers = []
-        for level, indexes, name in zip(level_shapefiles, level_indexes, self._level_names):
-            # Select the match file for this
-            match_file = self._set_match_file(level, year)
-
+        for overlaps, name in zip(level_overlaps, self._level_names):
             # Set a match unit for each sub unit
-            level_relations = [self._link_locations(place, rec, match_file, year, base_indexes, base_gid,
-                                                    indexes, ambiguous)
-                               for place, rec in zip(base_file.polygons, base_file.records)]
+            level_relations = [self._link_locations(rec, location_overlaps, year, base_indexes, base_gid, ambiguous)
+                               for rec, location_overlaps in zip(base_file.records, overlaps)]
 
             # Set the maximum number of rows so we can make a consistent length row
             relation_max = max([len(relation) for relation in level_relations])
@@ -182,13 +217,13 @@ class PlaceReference:
     def _set_match_file(match_files, year):
         """
         This takes a given list of match files and matches them against the same year of the base shape file. Returns
-        the ShapeObject object of the match.
+        the ShapeIndex of the match.
 
         :param year: The current year
         :type year: str
 
-        :return: Matching county ShapeObject
-        :rtype: ShapeObject
+        :return: Matching county ShapeIndex
+        :rtype: ShapeIndex
 
         :raises IndexError: If no match is found
         """
@@ -198,17 +233,16 @@ class PlaceReference:
 
         raise IndexError(f"Failed to find a match file for {year}")
 
-    def _link_locations(self, place, record, match_file, year, base_indexes, base_gid, level_indexes, ambiguous):
+    def _link_locations(self, record, location_overlaps, year, base_indexes, base_gid, ambiguous):
         """
-
-        :param place: The current places shape to match against
-        :type place: Polygon
+        Set the relations of the current base place to the names of a level that overlap it, recording them as
+        ambiguous if there is more than one.
 
         :param record: The record of the current place we wish to extract a name from via base_indexes
         :type record: list
 
-        :param match_file: The ShapeObject of the level we are looking for overlapping geometry off
-        :type match_file: ShapeObject
+        :param location_overlaps: The names of the level that overlap the current place, from _level_overlaps
+        :type location_overlaps: list[str]
 
         :param year: The year that if we find ambiguous relations we write to the first column
         :type year: str | int
@@ -219,9 +253,6 @@ class PlaceReference:
         :param base_gid: The index of the gid in the base shapefile, defaults to zero in call method
         :type base_gid: int
 
-        :param level_indexes: The indexes used to set the name of the matching geometry
-        :type level_indexes: list[int]
-
         :param ambiguous: Holder list for ambiguous relations
         :type ambiguous: list
 
@@ -232,9 +263,6 @@ class PlaceReference:
         # Set the name for the current base place
         base_name = self._set_name(record, base_indexes)
 
-        # Determine relations with the other shapefile that was matched on date
-        location_overlaps = self._determine_overlaps(place, match_file, level_indexes)
-
         # If more than one location was found, updated ambiguous
         if len(location_overlaps) > 1:
             ambiguous.append([year, record[base_gid], base_name] + location_overlaps)
@@ -243,27 +271,31 @@ class PlaceReference:
         # Return the relation information.
         return [record[base_gid], base_name] + location_overlaps
 
-    def _determine_overlaps(self, base_shape, other_shapefile, others_name_indexes):
+    def _level_overlaps(self, base_file, other_shapefile, others_name_indexes):
         """
         A district will be overlapped by a county, but it may have multiple relations which we would need to sort out
-        manually. To construct the list of relations and check for ambiguity the system iterates through each polygon
-        within a district and sees which county overlaps.
+        manually. To construct the list of relations and check for ambiguity the overlaps of every district with every
+        county are determined at once from the county's index, and the names of the counties overlapping each district
+        kept in record order.
 
-        :param base_shape: The current base shape
+        :param base_file: The base shapefile ShapeIndex
+        :type base_file: ShapeIndex
 
-        :param other_shapefile: The current level other shapefile ShapeObject
-        :type other_shapefile: ShapeObject
+        :param other_shapefile: The current level other shapefile ShapeIndex
+        :type other_shapefile: ShapeIndex
 
         :param others_name_indexes: The indexes of the other shapefiles records to use to construct a name
         :type others_name_indexes: list[int]
 
-        :return: County relationships for this given district
+        :return: County relationships for each district of the base shapefile
+        :rtype: list[list[str]]
         """
-        relationships = []
-        for other_shape, rec in zip(other_shapefile.polygons, other_shapefile.records):
-            if base_shape.intersection(other_shape).area > self._cut_off:
-                if self._set_name(rec, others_name_indexes) not in relationships:
-                    relationships.append(self._set_name(rec, others_name_indexes))
+        relationships = [[] for _ in range(len(base_file.polygons))]
+        base_indexes, match_indexes, _ = indexed_overlaps(base_file.polygons, other_shapefile, self._cut_off)
+        for base_index, match_index in zip(base_indexes, match_indexes):
+            name = self._set_name(other_shapefile.records[match_index], others_name_indexes)
+            if name not in relationships[base_index]:
+                relationships[base_index].append(name)
         return relationships
 
     @staticmethod
@@ -287,12 +319,12 @@ class PlaceReference:
 
         # Load the files for each shapefile that where written by link_districts_counties as well as the user ambiguous
         # file named ambiguity_file_name
-        ambiguity_file = self._ambiguity_setter(ambiguity, ambiguity_file_name)
+        ambiguity_index = self._ambiguity_setter(ambiguity, ambiguity_file_name)
         relation_files = [CsvObject(f"{self._working_dir}/{file}")
                           for file in directory_iterator(self._working_dir) if "_relation" in file]
 
         # Construct a list of all the names without any ambiguity
-        name_list = [self._fix_row_ambiguity(row, ambiguity_file, re.sub(r"[\D]", "", file.file_name))
+        name_list = [self._fix_row_ambiguity(row, ambiguity_index, re.sub(r"[\D]", "", file.file_name))
                      for file in relation_files for row in file.row_data]
 
         # Write out the reference base
@@ -317,17 +349,35 @@ class PlaceReference:
 
     def _ambiguity_setter(self, ambiguity, ambiguity_file_name):
         """
-        If there is ambiguity, load the fix file
+        If there is ambiguity, load the fix file and index its rows on (gid, year)
         """
         if ambiguity:
             try:
-                return CsvObject(f"{self._working_dir}/{ambiguity_file_name}", file_headers=False)
+                ambiguity_file = CsvObject(f"{self._working_dir}/{ambiguity_file_name}", file_headers=False)
             except FileNotFoundError:
                 raise FileNotFoundError(f"Ambiguity specified but no fix file named {ambiguity_file_name} found")
+            return self._index_ambiguity(ambiguity_file)
         else:
             return None
 
-    def _fix_row_ambiguity(self, row, ambiguity_file, year):
+    @staticmethod
+    def _index_ambiguity(ambiguity_file):
+        """
+        Index the rows of the ambiguity file, which are of [year, gid, base name, level names...], on (gid, year) so
+        each ambiguous row can be fixed by a single lookup. If a gid and year is repeated the first row is used.
+
+        :param ambiguity_file: The csvObject loaded ambiguity file
+        :type ambiguity_file: CsvObject
+
+        :return: A dict of {(gid, year): row without the year}
+        :rtype: dict
+        """
+        ambiguity_index = {}
+        for row in ambiguity_file.row_data:
+            ambiguity_index.setdefault((row[1], row[0]), row[1:])
+        return ambiguity_index
+
+    def _fix_row_ambiguity(self, row, ambiguity_index, year):
         """
         If there is any ambiguity in a row then it will have more than the number of levels, determine by the target
         length. This method matches the ambiguity rows on gid and then returns the row without any ambiguity. If the row
@@ -336,8 +386,8 @@ class PlaceReference:
         :param row: The current row from the relational file
         :type row: list
 
-        :param ambiguity_file: The csvObject loaded ambiguity file
-        :type ambiguity_file: CsvObject
+        :param ambiguity_index: The ambiguity file indexed on (gid, year)
+        :type ambiguity_index: dict
 
         :param year: The year we want to match
         :type year: int | str
@@ -347,7 +397,7 @@ class PlaceReference:
         if len(append_row) == self._target_length:
             return append_row
         else:
-            ambiguity_row = self._get_ambiguous_row(ambiguity_file, row[0], year)
+            ambiguity_row = self._get_ambiguous_row(ambiguity_index, row[0], year)
             if len(ambiguity_row) == self._target_length:
                 return ambiguity_row
             else:
@@ -355,12 +405,12 @@ class PlaceReference:
                                  f"{self._target_length}")
 
     @staticmethod
-    def _get_ambiguous_row(ambiguity_file, match_gid, year):
+    def _get_ambiguous_row(ambiguity_index, match_gid, year):
         """
-        Compare the year and row GID to the rows in the ambiguity file and return the match without the year.
+        Look up the year and row GID in the ambiguity index and return the match without the year.
 
-        :param ambiguity_file: The csvObject loaded ambiguity file
-        :type ambiguity_file: CsvObject
+        :param ambiguity_index: The ambiguity file indexed on (gid, year)
+        :type ambiguity_index: dict
 
         :param match_gid: The Gid to search for in the row
         :type match_gid: int | str
@@ -373,11 +423,9 @@ class PlaceReference:
 
         :raises IndexError: If a GID is not found but required to fix ambiguity
         """
-        for row in ambiguity_file.row_data:
-            if (match_gid in row) and (year in row):
-                return row[1:]
-
-        raise IndexError(f"Failed to find match gid {match_gid} for {ambiguity_file.file_name}")
+        if ambiguity_index is None or (match_gid, year) not in ambiguity_index:
+            raise IndexError(f"Failed to find match gid {match_gid} for {year} in the ambiguity file")
+        return ambiguity_index[match_gid, year]
 
     def construct_reference(self, base_weights_name="LookupBase.csv", alternative_key="Unique"):
         """
@@ -404,20 +452,39 @@ class PlaceReference:
         order = [index for header in self._headers for index, file in enumerate(alt_files) if header in file.file_name]
         alt_files = np.array(alt_files)[order].tolist()
 
-        # Link each row to a unique list to create the reference place look up file
+        # Index each alternative file on every name within it, then link each row to a unique list to create the
+        # reference place look up file
+        alt_indexes = [self._index_alternatives(alt_file) for alt_file in alt_files]
         rows = [flatten([[row[0]]] +
-                        [self._match_row(match, match_file) for match, match_file in zip(row[1:], alt_files)])
+                        [self._match_row(match, alt_index) for match, alt_index in zip(row[1:], alt_indexes)])
                 for row in base_relation.row_data]
 
         write_csv(self._working_dir, "PlaceReference", ["GID"] + flatten([file.headers for file in alt_files]), rows)
 
     @staticmethod
-    def _match_row(match, match_file):
+    def _index_alternatives(match_file):
         """
-        Find the match in a row within the match file, then return it
+        Index the rows of an alternatives file on each name within them, so that the first row containing a name can be
+        found with a single lookup
         """
+        alternatives_index = {}
         for match_row in match_file.row_data:
-            if match in match_row:
-                return match_row
+            for name in match_row:
+                alternatives_index.setdefault(name, match_row)
+        return alternatives_index
+
+    @staticmethod
+    def _match_row(match, alternatives_index):
+        """
+        Find the row of the match within the indexed match file, then return it
+        """
+        try:
+            return alternatives_index[match]
+        except KeyError:
+            raise KeyError(f"Failed to find {match}")
+
 
-        raise KeyError(f"Failed to find {match}")
+def _pair_overlaps(state, pair_index):
+    """Determine the overlaps of a (year, level) pair of _year_level_overlaps, within a worker process"""
+    place_reference, pairs = state
+    return place_reference._level_overlaps(*pairs[pair_index])
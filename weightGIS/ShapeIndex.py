@@ -0,0 +1,297 @@
+from shapely.geometry import Polygon, MultiPolygon
+from shapely import STRtree, bounds, box, from_wkb, to_wkb
+from typing import BinaryIO, Callable, Optional, Sequence, Tuple, Union
+from collections import OrderedDict
+from shapeObject import ShapeObject
+from datetime import date
+from pathlib import Path
+import numpy as np
+import hashlib
+import json
+import os
+
+
+class ShapeIndex:
+    def __init__(self, shape_object: ShapeObject):
+        """
+        Holds the polygons and records of a ShapeObject alongside a STRtree of its polygons, so that overlap searches
+        only need to consider polygons whose bounding boxes intersect the search shape rather than every polygon.
+        """
+        # ShapeObject rebuilds these lists on every access, so isolate them once with the polygons held as an array so
+        # they can be passed to shapely's vectorised functions
+        self._set_geometry(shape_object.file_name, np.array(shape_object.polygons, dtype=object), shape_object.records)
+
+    @classmethod
+    def from_shapefile(cls, shapefile_path: Union[str, Path]) -> "ShapeIndex":
+        """Index a shapefile, loading it from its geometry snapshot if it has a valid one. See load_shapefile"""
+        shape_index = cls.__new__(cls)
+        shape_index._set_geometry(*load_shapefile(shapefile_path))
+        return shape_index
+
+    def _set_geometry(self, file_name: str, polygons: np.ndarray, records: list) -> None:
+        """Hold the polygons and records of a shapefile, and index the polygons"""
+        self.file_name = file_name
+        self.polygons = polygons
+        self.records = records
+        self.tree = STRtree(self.polygons)
+
+    def __repr__(self):
+        return f"{self.file_name} indexed {len(self.polygons)} polygons"
+
+    def __getstate__(self):
+        """Ship the polygons as a single WKB array rather than pickling each geometry, the tree is rebuilt on load"""
+        return {"file_name": self.file_name, "wkb": to_wkb(self.polygons), "records": self.records}
+
+    def __setstate__(self, state):
+        self._set_geometry(state["file_name"], from_wkb(state["wkb"]), state["records"])
+
+    def candidate_pairs(self, geometry: Union[Polygon, MultiPolygon, Sequence, np.ndarray]) -> np.ndarray:
+        """
+        Return a 2 x N array of [geometry index, polygon index] pairs where the bounding box of an element of geometry
+        intersects the bounding box of one of our polygons. Pairs are ordered by geometry index then polygon index, so
+        for any given geometry its candidates are in record order.
+        """
+        pairs = self.tree.query(np.atleast_1d(geometry))
+        return pairs[:, np.lexsort((pairs[1], pairs[0]))]
+
+
+class LazyPolygons:
+    def __init__(self, geometry_path: Union[str, Path], offsets: np.ndarray, cache_size: int):
+        """
+        The polygons of a shapefile's snapshot, materialised from its memory mapped WKB blob only when they are indexed.
+        Up to cache_size of the most recently used polygons are kept rather than parsed again.
+        """
+        self._blob = np.load(geometry_path, mmap_mode="r")
+        self._offsets = offsets.tolist()
+        self._cache_size = cache_size
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, item: Union[int, slice, Sequence[int], np.ndarray]):
+        """Return a polygon for an integer index, otherwise an object array of the polygons indexed"""
+        if isinstance(item, (int, np.integer)):
+            return self._polygon(int(item))
+
+        indexes = np.arange(len(self))[item].tolist()
+        polygons = np.empty(len(indexes), dtype=object)
+        polygons[:] = [self._polygon(index) for index in indexes]
+        return polygons
+
+    def _polygon(self, index: int) -> Union[Polygon, MultiPolygon]:
+        """Return the polygon at index, parsing it from the blob if it is not cached"""
+        if index in self._cache:
+            self._cache.move_to_end(index)
+            return self._cache[index]
+
+        polygon = from_wkb(self._blob[self._offsets[index]:self._offsets[index + 1]].tobytes())
+        self._cache[index] = polygon
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return polygon
+
+
+class LazyShapeIndex(ShapeIndex):
+    def __init__(self, shapefile_path: Union[str, Path], cache_size: int = 256):
+        """
+        A ShapeIndex whose records are read eagerly but whose polygons are only materialised when they are accessed,
+        from the memory mapped WKB blob of the shapefile's snapshot. The STRtree is built from the bounding boxes held
+        in the snapshot, so finding candidates never requires the polygons themselves.
+
+        Only the polygons in use, and the pages of the blob the operating system chooses to keep, are resident, so many
+        large shapefiles can be held at once. If the shapefile has no valid snapshot, it is loaded and one is written.
+        """
+        self._shapefile_path = shapefile_path
+        self._cache_size = cache_size
+
+        index = _read_index(shapefile_path)
+        if index is None:
+            file_name, polygons, records = load_shapefile(shapefile_path)
+            index = _read_index(shapefile_path)
+
+        # If a snapshot could not be written, the polygons have to be held as they are
+        if index is None:
+            self.polygons, polygon_bounds = polygons, bounds(polygons)
+        else:
+            file_name, records, polygon_bounds = index["FileName"], index["Records"], index["Bounds"]
+            self.polygons = LazyPolygons(_snapshot_paths(shapefile_path)[0], index["Offsets"], cache_size)
+
+        self.file_name = file_name
+        self.records = records
+
+        # Empty polygons have no bounds, and are left out of the tree as they would be for a tree of the polygons
+        boxes = box(*np.asarray(polygon_bounds, dtype=np.float64).reshape(-1, 4).T)
+        boxes[np.isnan(polygon_bounds).any(axis=1)] = None
+        self.tree = STRtree(boxes)
+
+    def __getstate__(self):
+        """Ship the path of the shapefile, so each process maps the snapshot itself"""
+        return {"shapefile_path": self._shapefile_path, "cache_size": self._cache_size}
+
+    def __setstate__(self, state):
+        self.__init__(state["shapefile_path"], state["cache_size"])
+
+
+def shapefile_fingerprint(shapefile_path: Union[str, Path]) -> str:
+    """
+    Return a sha256 hash of the geometry, index and attribute files that make up a shapefile, so that changes to a
+    shapefile on disk can be detected
+    """
+    digest = hashlib.sha256()
+    for suffix in (".shp", ".shx", ".dbf"):
+        component = Path(shapefile_path).with_suffix(suffix)
+        if component.exists():
+            digest.update(suffix.encode())
+            with open(component, "rb") as component_file:
+                for block in iter(lambda: component_file.read(1 << 20), b""):
+                    digest.update(block)
+    return digest.hexdigest()
+
+
+def shapefile_stamp(shapefile_path: Union[str, Path]) -> str:
+    """
+    Return a hash of the size and modification time of the files that make up a shapefile. Unlike
+    shapefile_fingerprint the files are not read, so this is near instant but only detects changes that touch them.
+    """
+    stamp = hashlib.sha256()
+    for suffix in (".shp", ".shx", ".dbf"):
+        component = Path(shapefile_path).with_suffix(suffix)
+        if component.exists():
+            component_stat = component.stat()
+            stamp.update(f"{suffix}:{component_stat.st_size}:{component_stat.st_mtime_ns}".encode())
+    return stamp.hexdigest()
+
+
+def cached_fingerprint(shapefile_path: Union[str, Path]) -> str:
+    """
+    Return the shapefile_fingerprint of a shapefile, reusing the one held in its ShapeCache when its shapefile_stamp is
+    unchanged since it was calculated, so only shapefiles that have been touched are read and hashed again
+    """
+    fingerprint_path = Path(shapefile_path).parent / "ShapeCache" / f"{Path(shapefile_path).stem}_Fingerprint.json"
+    stamp = shapefile_stamp(shapefile_path)
+    try:
+        with open(fingerprint_path, encoding="utf-8") as fingerprint_file:
+            cached = json.load(fingerprint_file)
+        if cached["Stamp"] == stamp:
+            return cached["Fingerprint"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    fingerprint = shapefile_fingerprint(shapefile_path)
+    cached = json.dumps({"Stamp": stamp, "Fingerprint": fingerprint}).encode()
+    try:
+        fingerprint_path.parent.mkdir(exist_ok=True)
+        replace_file(fingerprint_path, lambda fingerprint_file: fingerprint_file.write(cached))
+    except OSError as error:
+        print(f"Warning: Failed to cache the fingerprint of {Path(shapefile_path).name}: {error}")
+    return fingerprint
+
+
+def _snapshot_paths(shapefile_path: Union[str, Path]) -> Tuple[Path, Path]:
+    """The geometry blob and index of a shapefile's snapshot, within a ShapeCache directory alongside it"""
+    cache_directory = Path(shapefile_path).parent / "ShapeCache"
+    name = Path(shapefile_path).stem
+    return Path(cache_directory, f"{name}_Geometry.npy"), Path(cache_directory, f"{name}_Index.json")
+
+
+def replace_file(file_path: Path, write: Callable[[BinaryIO], None]) -> None:
+    """
+    Write a file through write to a temporary file alongside it, and then replace file_path with it. A reader never
+    sees a partially written file, and a handle that has the previous file memory mapped keeps mapping it.
+    """
+    temporary_path = file_path.with_name(f"{file_path.name}.{os.getpid()}.tmp")
+    try:
+        with open(temporary_path, "wb") as temporary_file:
+            write(temporary_file)
+        os.replace(temporary_path, file_path)
+    finally:
+        temporary_path.unlink(missing_ok=True)
+
+
+def _encode_record_value(value):
+    """Hold the dates pyshp reads from date fields as {"Date": isoformat}, as json has no date type"""
+    if isinstance(value, date):
+        return {"Date": value.isoformat()}
+    raise TypeError(f"{type(value).__name__} values of records cannot be held in a snapshot")
+
+
+def _decode_record_value(value: dict):
+    """Restore the dates held by _encode_record_value"""
+    return date.fromisoformat(value["Date"]) if value.keys() == {"Date"} else value
+
+
+def write_snapshot(shapefile_path: Union[str, Path], file_name: str, polygons: np.ndarray, records: list) -> None:
+    """
+    Write a snapshot of the polygons of a shapefile, as a single blob of their WKB, and of its records alongside the
+    offset and bounds of each polygon as a json index. Each file is replaced whole rather than rewritten in place, with
+    the index replaced last, so a snapshot is only ever read once it is complete.
+    """
+    geometry_path, index_path = _snapshot_paths(shapefile_path)
+    wkb = to_wkb(polygons).tolist() if len(polygons) > 0 else []
+    offsets = np.cumsum([0] + [len(polygon_wkb) for polygon_wkb in wkb], dtype=np.int64)
+    index = {"Stamp": shapefile_stamp(shapefile_path), "FileName": file_name, "Offsets": offsets.tolist(),
+             "Bounds": bounds(polygons).reshape(-1, 4).tolist(), "Records": [list(record) for record in records]}
+
+    try:
+        index = json.dumps(index, ensure_ascii=False, default=_encode_record_value).encode("utf-8")
+        geometry_path.parent.mkdir(exist_ok=True)
+        replace_file(geometry_path, lambda blob_file: np.save(blob_file, np.frombuffer(b"".join(wkb), np.uint8)))
+        replace_file(index_path, lambda index_file: index_file.write(index))
+    except (OSError, TypeError, ValueError) as error:
+        print(f"Warning: Failed to write a geometry snapshot of {file_name}: {error}")
+
+
+def _read_index(shapefile_path: Union[str, Path]) -> Optional[dict]:
+    """
+    Read the index of a shapefile's snapshot, or None if it does not have one, the shapefile has changed since it was
+    written, or the snapshot cannot be read in any way, so that it is rebuilt
+    """
+    geometry_path, index_path = _snapshot_paths(shapefile_path)
+    if not (index_path.exists() and geometry_path.exists()):
+        return None
+
+    # Any failure to read the snapshot, or a snapshot inconsistent with itself, means it is stale rather than an error
+    try:
+        with open(index_path, encoding="utf-8") as index_file:
+            index = json.load(index_file, object_hook=_decode_record_value)
+        if index["Stamp"] != shapefile_stamp(shapefile_path):
+            return None
+
+        index["Offsets"] = np.asarray(index["Offsets"], dtype=np.int64).reshape(-1)
+        index["Bounds"] = np.asarray(index["Bounds"], dtype=np.float64).reshape(-1, 4)
+        polygon_count = len(index["Records"])
+        if len(index["Offsets"]) != polygon_count + 1 or len(index["Bounds"]) != polygon_count or \
+                np.load(geometry_path, mmap_mode="r").size != index["Offsets"][-1] or \
+                not isinstance(index["FileName"], str):
+            return None
+    except Exception:
+        return None
+    return index
+
+
+def read_snapshot(shapefile_path: Union[str, Path]) -> Optional[Tuple[str, np.ndarray, list]]:
+    """
+    Read the file name, polygons and records of a shapefile from its snapshot, or None if it does not have a valid one
+    """
+    index = _read_index(shapefile_path)
+    if index is None:
+        return None
+
+    blob, offsets = np.load(_snapshot_paths(shapefile_path)[0], mmap_mode="r"), index["Offsets"].tolist()
+    wkb = np.array([blob[start:stop].tobytes() for start, stop in zip(offsets, offsets[1:])], dtype=object)
+    return index["FileName"], from_wkb(wkb), index["Records"]
+
+
+def load_shapefile(shapefile_path: Union[str, Path]) -> Tuple[str, np.ndarray, list]:
+    """
+    Load the file name, polygons and records of a shapefile. Parsing a shapefile through ShapeObject is slow, so the
+    result is snapshot to a ShapeCache directory alongside the shapefile and later loads read the snapshot instead,
+    for as long as the size and modification time of the shapefile's files are unchanged.
+    """
+    snapshot = read_snapshot(shapefile_path)
+    if snapshot is None:
+        shape_object = ShapeObject(shapefile_path)
+        snapshot = (shape_object.file_name, np.array(shape_object.polygons, dtype=object), shape_object.records)
+        write_snapshot(shapefile_path, *snapshot)
+    return snapshot
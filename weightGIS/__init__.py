@@ -7,6 +7,7 @@ from weightGIS.weighting.ConstructWeights import ConstructWeights
 from weightGIS.weighting.AdjustWeights import AdjustWeights
 from weightGIS.weighting.AssignWeights import AssignWeights
 from weightGIS.weighting.WeightExternal import WeightExternal
+from weightGIS.weighting.ColumnarStore import prune_weight_plans, write_columnar_database, write_columnar_weights
 
 # Additional methods that support the main pipeline
 from weightGIS.IDAssignment import IDLocate
@@ -1,3 +1,5 @@
+from weightGIS.weighting.StreamWeights import is_streamed, iterate_weights, rewrite_weights
+
 from miscSupports import load_json, write_json
 from csvObject.csvWriter import write_csv
 from pathlib import Path
@@ -5,10 +7,13 @@ from pathlib import Path
 
 class AdjustWeights:
     def __init__(self, working_directory, weights_path):
+        """
+        Adjust a set of weights. The weights may be either a json, or a streamed .jsonl, file. Streamed weights are read
+        one place at a time, and rewritten line by line, rather than being loaded into memory.
+        """
         self._working_dir = working_directory
         self._weights_path = Path(weights_path)
         assert self._weights_path.exists(), "Path to weights is invalid"
-        self._weights = load_json(self._weights_path)
 
     def replace_assigned_weight(self, fixed_json_path, name):
         """
@@ -27,24 +32,47 @@ class AdjustWeights:
         """
         # Load the fix file
         fixed = load_json(fixed_json_path)
+        if name not in fixed:
+            raise KeyError(name)
 
-        # Create the restructured values for the named place
-        key_list = self._replacement_keys(name, fixed)
-        restructured = {str(year): self._replacement_values(fixed, name, year, new) for year, new in key_list}
+        # Updating the existing weights with the restructured values for the named place
+        self._write_weights(self._edit_place(name, lambda weights: self._restructure(name, weights, fixed)))
 
-        # Updating the existing json with the new information
-        write_data = self._weights
-        write_data[name] = restructured
-        write_json(write_data, self._weights_path.parent, self._weights_path.stem)
+    def _edit_place(self, name, edit):
+        """
+        Yield each place and its weights from the weights file, with the weights of the place called name replaced by
+        edit of them. If no place is called name a KeyError is raised once every place has been read, so the weights
+        file is never rewritten.
+        """
+        found = False
+        for place, weights in iterate_weights(self._weights_path):
+            if place == name:
+                found = True
+                weights = edit(weights)
+            yield place, weights
+
+        if not found:
+            raise KeyError(name)
+
+    def _restructure(self, name, place_weights, fixed):
+        """
+        Create the restructured values for the named place from its original place_weights and the fixed file
+        """
+        key_list = self._replacement_keys(name, place_weights, fixed)
+        return {str(year): self._replacement_values(place_weights, fixed, name, year, new) for year, new in key_list}
 
-    def _replacement_keys(self, name, fixed):
+    @staticmethod
+    def _replacement_keys(name, place_weights, fixed):
         """
         This Creates a true false list of keys, where True means that the values will be taken from then fixed file and
         false from the original
 
-        :param name: The place name that exists in both the master _weights and the fixed file that was loaded
+        :param name: The place name that exists in both the master weights and the fixed file that was loaded
         :type name: str
 
+        :param place_weights: The named place's weights within the master weights
+        :type place_weights: dict
+
         :param fixed: The json data that is going to be used to replace values in the master _weights database that has
             been loaded into a dict
         :type fixed: dict
@@ -54,8 +82,8 @@ class AdjustWeights:
             original.
         :rtype: list[list[int, bool]]
         """
-        # Isolate the weight as a date, represent as an int, for all the weights in the current place in the _weights
-        original_weights = [int(key) for key in self._weights[name].keys()]
+        # Isolate the weight as a date, represent as an int, for all the weights in the current place
+        original_weights = [int(key) for key in place_weights.keys()]
 
         # If the date does not exist in the fixed file, keep the original, otherwise set the new value from fixed
         new_weights = [[key, False] for key in original_weights] + \
@@ -65,14 +93,15 @@ class AdjustWeights:
         new_weights.sort(key=lambda x: x[0])
         return new_weights
 
-    def _replacement_values(self, fixed, name, year, new):
+    @staticmethod
+    def _replacement_values(place_weights, fixed, name, year, new):
         """
         Assign attribute data from the new, or old data based on where the data is.
         """
         if new:
             return fixed[name][str(year)]
         else:
-            return self._weights[name][str(year)]
+            return place_weights[str(year)]
 
     def remove_weight(self, place, weight_date):
         """
@@ -92,16 +121,10 @@ class AdjustWeights:
         :return: Nothing, remove from the master then stop
         :rtype: None
         """
-        # Load the current place form the weights
-        current = self._weights[place]
-
-        # Create the replacement, where the each date is assign its previous weight places as long as the date does not
-        # equal the weight_date provided
-        replacement = {date: weight_places for date, weight_places in current.items() if date != weight_date}
-
-        # Replace original place weights with replacement
-        self._weights[place] = replacement
-        write_json(self._weights, self._weights_path.parent, self._weights_path.stem)
+        # Create the replacement for the place, where the each date is assign its previous weight places as long as the
+        # date does not equal the weight_date provided, then replace the original place weights with the replacement
+        self._write_weights(self._edit_place(place, lambda weights: {
+            date: weight_places for date, weight_places in weights.items() if date != weight_date}))
 
     def add_place(self, new_weight):
         """
@@ -117,9 +140,15 @@ class AdjustWeights:
         :rtype: None
         """
 
-        for key in new_weight.keys():
-            self._weights[key] = new_weight[key]
-        write_json(self._weights, self._weights_path.parent, self._weights_path.stem)
+        def updated_weights():
+            # Replace any existing places with their new weights, then add the places that did not already exist
+            existing = set()
+            for place, weights in iterate_weights(self._weights_path):
+                existing.add(place)
+                yield place, new_weight.get(place, weights)
+            yield from ((place, weights) for place, weights in new_weight.items() if place not in existing)
+
+        self._write_weights(updated_weights())
 
     def remove_place(self, places_to_remove):
         """
@@ -135,8 +164,8 @@ class AdjustWeights:
         :rtype: None
         """
 
-        self._weights = {key: value for key, value in self._weights.items() if key not in places_to_remove}
-        write_json(self._weights, self._weights_path.parent, self._weights_path.stem)
+        self._write_weights((key, value) for key, value in iterate_weights(self._weights_path)
+                            if key not in places_to_remove)
 
     def write_out_changes(self, write_name, population_weights=True):
         """
@@ -150,18 +179,19 @@ class AdjustWeights:
         :return: Nothing, just write out the csv file with the number of expected changes and support search terms
         :rtype: None
         """
-        write_holder = [[weight_group, len(self._determine_changes(weight_group, population_weights)) - 1]
-                        for weight_group in self._weights]
+        write_holder = [[weight_group, len(self._determine_changes(place_weights, population_weights)) - 1]
+                        for weight_group, place_weights in iterate_weights(self._weights_path)]
 
         write_csv(self._working_dir, write_name, ["Place", "Expected_Changes"], write_holder)
         print("Written out changes!")
 
-    def _determine_changes(self, weight_group, population_weights):
+    @staticmethod
+    def _determine_changes(place_weights, population_weights):
         """
-        Check to see if any changes occur for the current places's weight_group within the base weights
+        Check to see if any changes occur for the current places's weights within the base weights
 
-        :param weight_group: The current changes for the current place
-        :type weight_group: int
+        :param place_weights: The current changes for the current place
+        :type place_weights: dict
 
         :param population_weights: If population weights where used
         :type: bool
@@ -170,7 +200,7 @@ class AdjustWeights:
         :rtype: list
         """
         cleaned_of_duplication = []
-        for value in self._weights[weight_group].values():
+        for value in place_weights.values():
             if population_weights:
                 non_duplication = [[k, v["Area"], v["Population"]] for k, v in zip(value.keys(), value.values())]
             else:
@@ -180,3 +210,13 @@ class AdjustWeights:
                 cleaned_of_duplication.append(non_duplication)
 
         return cleaned_of_duplication
+
+    def _write_weights(self, places):
+        """
+        Write the places and weights back to the weights file. Streamed weights are rewritten line by line, otherwise
+        the places are collected into a single json dict.
+        """
+        if is_streamed(self._weights_path):
+            rewrite_weights(self._weights_path, places)
+        else:
+            write_json(dict(places), self._weights_path.parent, self._weights_path.stem)
@@ -1,16 +1,25 @@
-from miscSupports import load_json, write_json, invert_dates
+from weightGIS.weighting.StreamWeights import is_streamed, iterate_weights
+
+from miscSupports import write_json, invert_dates, load_json
 from csvObject.csvObject import CsvObject
 from pathlib import Path
+import numpy as np
 
 
 class AssignWeights:
-    def __init__(self, weights_path, working_dir, write_name, dates_path, population_weights=True, raw_years=None):
+    def __init__(self, weights_path, working_dir, write_name, dates_path, population_weights=True, raw_years=None,
+                 gid_index=0):
         """
-        This class contains the methods needed to actually assign the weights to a usable database
+        This class contains the methods needed to actually assign the weights to a usable database. The weights may be
+        either a json, or a streamed .jsonl, file from ConstructWeights; each place's weights are read as they are
+        assigned.
+
+        The dates file is parsed once into an index of each place's change dates, keyed on the GID held in the column
+        gid_index, so the changes of each place can be looked up directly as it is assigned.
         """
 
-        self._working_dir, self._weights, self._weight_key, self._dates, self._date_indexes = self._setup(
-            working_dir, weights_path, population_weights, dates_path)
+        self._working_dir, self._weights_path, self._weight_key, self._changes = self._setup(
+            working_dir, weights_path, population_weights, dates_path, gid_index)
 
         self._working_dir = Path(working_dir)
         self._write_name = write_name
@@ -29,12 +38,23 @@ class AssignWeights:
         :rtype: None
         """
 
+        # A weights json is loaded once and walked in both passes, whereas streamed weights are read again for the
+        # second pass so that only a single place's weights are held at a time
+        weights = None if is_streamed(self._weights_path) else load_json(self._weights_path)
+
+        # Extract the number of possible changes from the weight data and determine if any changes occur from the
+        # dates data, so the observed dates of every place can be determined at once
+        place_changes = {}
+        for place_over_time, place_weights in self._iterate_weights(weights):
+            shapefile_years = self._set_shapefile_years(adjust_dates, place_weights)
+            place_changes[place_over_time] = (
+                shapefile_years, self._extract_relevant_changes(place_over_time.split("__")[0], shapefile_years))
+
+        observed_dates = self._observed_dates(place_changes)
+
         weights_list = {}
-        for place_over_time in self._weights:
-            # Extract the number of possible changes from the weight data and determine if any changes occur from the
-            # dates data
-            shapefile_years = self._set_shapefile_years(adjust_dates, place_over_time)
-            changes = self._extract_relevant_changes(place_over_time.split("__")[0], shapefile_years)
+        for place_over_time, place_weights in self._iterate_weights(weights):
+            shapefile_years, changes = place_changes[place_over_time]
 
             if len(changes) == 0:
                 # If no changes occur, just access the first entry and set our dictionary to these values
@@ -42,32 +62,31 @@ class AssignWeights:
             else:
                 # Otherwise assign dates of the changes to occur over time.
                 weights_over_time = self._assigned_dates_to_weights(
-                    place_over_time, self._observed_dates(changes, shapefile_years), shapefile_years)
+                    place_weights, observed_dates.get(place_over_time, {}), shapefile_years)
 
-                weights_list[place_over_time] = {date: {place: weight for place, weight in place_weights}
-                                                 for date, place_weights in weights_over_time}
+                weights_list[place_over_time] = {date: {place: weight for place, weight in date_weights}
+                                                 for date, date_weights in weights_over_time}
 
         write_json(weights_list, self._working_dir, self._write_name)
 
-    def _extract_relevant_changes(self, current_gid, shapefile_years, dl="-"):
+    def _iterate_weights(self, weights):
+        """Iterate the places and weights of the loaded weights json, or of the streamed weights if None"""
+        return iterate_weights(self._weights_path) if weights is None else weights.items()
+
+    def _extract_relevant_changes(self, current_gid, shapefile_years):
         """
-        If the GID is within the a given row of data from dates file then we want to extract the date columns from that
-        row by using the dates_indexes as an indexer. The format that is used is yyyymmdd so we then want to invert
-        these proper dates and only keep the ones that are within the range of our census years
+        Extract the dates of change of the current GID from the dates index, which holds them in yyyymmdd format, and
+        if raw years are provided add the shapefile years that are not raw years
 
         :param current_gid: The current GID of the current place
         :type: str
 
-        :param dl: The character used as the blank
-        :type dl: str
-
         :return: A list of relevant dates of changes in the format of [yyyymmdd, ... yyyymmdd]
         :rtype: list
         """
 
-        place = self._get_place(current_gid)
-        # Create the dates from Weight_Dates.csv
-        dates = [int(invert_dates(place[i])) for i in range(len(place)) if i in self._date_indexes and place[i] != dl]
+        # A place without a row in Weight_Dates.csv has no dates of change
+        dates = self._changes.get(str(current_gid), [])
 
         # If we have raw years provided, because we have additional dates within the shapefiles, then look for
         # them
@@ -78,69 +97,65 @@ class AssignWeights:
         else:
             return dates
 
-    def _get_place(self, current_gid):
-        """Extract the row we need if the gid is in it"""
-        for place in self._dates.row_data:
-            if str(current_gid) in place:
-                return place
-
-    def _observed_dates(self, changes, shapefile_years):
-        """
-        Multiple changes can occur in a census period but only the latest can be observed. This groups the changes by
-        census period and the returns a list of dates that can actually be observed
-
-        :param changes: list of changes in yyyymmdd format
-        :type changes: list
-
-        :return: A list of observed dates in the form of [yyyymmdd ... yyyymmdd]
-        :rtype: list
-        """
-
-        census_year_groupings = []
-        for change_date in changes:
-            for index in range(len(shapefile_years)):
-                if (shapefile_years[index] < change_date <= shapefile_years[index + 1]) and \
-                        (index < len(shapefile_years) - 1):
-                    census_year_groupings.append([shapefile_years[index + 1], change_date])
-
-        return self._select_latest(census_year_groupings)
-
     @staticmethod
-    def _select_latest(grouped_census_dates):
+    def _observed_dates(place_changes):
         """
-        This will selected the latest year between a given census period, as only the latest can be observed in the
-        shapefile
+        Multiple changes can occur in a census period but only the latest can be observed. This groups the changes of
+        every place by census period and returns the dates that can actually be observed.
 
-        :param grouped_census_dates: List of dates in the form of [[census_year, date]] where both dates are in yyyymmdd
-        :type grouped_census_dates: list
+        Places are grouped by their shapefile years, and the census period of every change of every place in a group is
+        found with a single binary search of the years. A change falls in the period ending at shapefile_years[index]
+        when shapefile_years[index - 1] < change <= shapefile_years[index], and changes on or before the first year or
+        after the last year cannot be observed so are dropped.
 
-        :return: A list of observed dates in the form of [yyyymmdd ... yyyymmdd]
-        :rtype: list
+        :param place_changes: A dict of {place: (shapefile_years, changes)} where both are lists in yyyymmdd format
+        :type place_changes: dict
+
+        :return: A dict of {place: {index: yyyymmdd}} of the latest change observed in the census period ending at
+            shapefile_years[index], for each place with an observable change
+        :rtype: dict
         """
-        memory = []
-        observed_dates = []
-        for census_year, date in grouped_census_dates:
-            if census_year not in memory:
-                memory.append(census_year)
-                observed_dates.append(max([match_date for match_year, match_date in grouped_census_dates
-                                           if match_year == census_year]))
+        year_groups = {}
+        for place, (shapefile_years, changes) in place_changes.items():
+            if len(changes) > 0:
+                year_groups.setdefault(tuple(shapefile_years), []).append(place)
+
+        observed_dates = {}
+        for shapefile_years, places in year_groups.items():
+            place_indexes = np.concatenate([np.full(len(place_changes[place][1]), i) for i, place in enumerate(places)])
+            changes = np.concatenate([place_changes[place][1] for place in places]).astype(np.int64)
+            periods = np.searchsorted(shapefile_years, changes, side="left")
+
+            observable = (periods > 0) & (periods < len(shapefile_years))
+            place_indexes, changes, periods = place_indexes[observable], changes[observable], periods[observable]
+
+            # Order by place, then period, then date so the last entry of each place-period is its latest change
+            order = np.lexsort((changes, periods, place_indexes))
+            place_indexes, changes, periods = place_indexes[order], changes[order], periods[order]
+            latest = np.ones(len(order), dtype=bool)
+            latest[:-1] = (place_indexes[1:] != place_indexes[:-1]) | (periods[1:] != periods[:-1])
+
+            for place_index, period, change in zip(place_indexes[latest].tolist(), periods[latest].tolist(),
+                                                   changes[latest].tolist()):
+                observed_dates.setdefault(places[place_index], {})[period] = change
 
         return observed_dates
 
-    def _set_shapefile_years(self, adjust_dates, place_over_time):
+    @staticmethod
+    def _set_shapefile_years(adjust_dates, place_weights):
         """
-        Set the shapefile dates based on the number of keys that exist for a given place_over_time in self.weights
+        Set the shapefile dates based on the number of keys that exist for a given place's weights
 
         :param adjust_dates: If we need to adjust the dates by a set amount, concatenate this to the dates found
-        :param place_over_time: The current place
+        :param place_weights: The current place's weights
         :return: List of dates to search between
         """
         if adjust_dates:
-            return [int(date + adjust_dates) for date in list(self._weights[place_over_time].keys())]
+            return [int(date + adjust_dates) for date in list(place_weights.keys())]
         else:
-            return [int(date) for date in list(self._weights[place_over_time].keys())]
+            return [int(date) for date in list(place_weights.keys())]
 
-    def _assigned_dates_to_weights(self, place_over_time, dates_observed, shapefile_years):
+    def _assigned_dates_to_weights(self, place_weights, dates_observed, shapefile_years):
         """
         This assigns the date to the change that has been observed in the shapefile.
 
@@ -179,11 +194,12 @@ class AssignWeights:
 
         Parameters
         ----------
-        :param dates_observed: The dates that we observed for this place
-        :type dates_observed: list
+        :param dates_observed: The dates that we observed for this place, keyed by the index of the census year that
+            observes them
+        :type dates_observed: dict
 
-        :param place_over_time: The current Places weight changes from census years
-        :type place_over_time: list
+        :param place_weights: The current Places weight changes from census years
+        :type place_weights: dict
 
         :return: A list for all the weights changes that occur to a given place by the date of which the change occurs
             in the form of list[date1[gid, district_name, area_weight, pop_weight]... dateN[gid, district_name,
@@ -191,33 +207,29 @@ class AssignWeights:
         :rtype: list
         """
         weights_by_date = []
-        for index, values in enumerate(self._weights[place_over_time].values()):
+        for index, values in enumerate(place_weights.values()):
             if index == 0:
                 weights_by_date.append([min(shapefile_years)] + [[[v, values[v][self._weight_key]] for v in values]])
-            else:
-                for date in dates_observed:
-                    if shapefile_years[index - 1] < date <= shapefile_years[index]:
-                        weights_by_date.append([date] + [[[v, values[v][self._weight_key]] for v in values]])
+            elif index in dates_observed:
+                weights_by_date.append([dates_observed[index]] + [[[v, values[v][self._weight_key]] for v in values]])
 
         return weights_by_date
 
     @staticmethod
-    def _setup(working_directory, weights_path, population_weights, dates_path):
+    def _setup(working_directory, weights_path, population_weights, dates_path, gid_index):
         """
-        Validate paths, load files, and set weight key nad date indexes
+        Validate paths, load files, and set weight key and the index of dates of change
         """
 
         assert Path(working_directory).exists(), f"Working Directory invalid"
 
-        # Validate dates and load the csv
+        # Validate dates and index the dates of change of each place
         assert Path(dates_path).exists(), "Dates path invalid"
-        dates = CsvObject(dates_path)
-        date_indexes = [index for index, head in enumerate(dates.headers) if "Changes" in head]
+        changes = AssignWeights._index_changes(CsvObject(dates_path), gid_index)
 
-        # Validate weights path and load the json
+        # Validate weights path, the weights themselves are read as they are assigned
         weights_path = Path(weights_path)
         assert weights_path.exists()
-        weights = load_json(weights_path)
 
         # Determine the population key based on the type specified
         if population_weights:
@@ -225,4 +237,31 @@ class AssignWeights:
         else:
             weight_key = "Area"
 
-        return working_directory, weights, weight_key, dates, date_indexes
+        return working_directory, weights_path, weight_key, changes
+
+    @staticmethod
+    def _index_changes(dates, gid_index, dl="-"):
+        """
+        Index the dates of change of each place in the dates file by its GID. The dates are extracted from the columns
+        with Changes in their header, skipping blanks, and inverted from dd/mm/yyyy to yyyymmdd integers.
+
+        :param dates: The loaded Weight_Dates csv
+        :type dates: CsvObject
+
+        :param gid_index: The index of the GID column
+        :type gid_index: int
+
+        :param dl: The character used as the blank
+        :type dl: str
+
+        :return: A dict of {GID: [yyyymmdd, ... yyyymmdd]}
+        :rtype: dict
+        """
+        date_indexes = [index for index, head in enumerate(dates.headers) if "Changes" in head]
+
+        changes = {}
+        for place in dates.row_data:
+            # If a GID is duplicated only the first row is used
+            if place[gid_index] not in changes:
+                changes[place[gid_index]] = [int(invert_dates(place[i])) for i in date_indexes if place[i] != dl]
+        return changes
@@ -0,0 +1,370 @@
+from weightGIS.ShapeIndex import replace_file
+
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+from miscSupports import load_json
+from pathlib import Path
+import numpy as np
+import hashlib
+import shutil
+import json
+import os
+
+
+def is_columnar(path: Union[str, Path]) -> bool:
+    """Columnar stores are directories holding an Index.txt of their interned keys alongside their .npy columns"""
+    return Path(path, "Index.txt").exists()
+
+
+def file_hash(file_path: Union[str, Path]) -> str:
+    """Return a sha256 hash of a file's contents"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as hash_file:
+        for block in iter(lambda: hash_file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _write_columns(write_directory: Union[str, Path], write_name: str, index: dict,
+                   columns: Dict[str, np.ndarray]) -> Path:
+    """
+    Write each column as a .npy file in a directory called write_name, with the index written last so that a store
+    that failed whilst writing is not recognised as columnar. Every file is written to a temporary file and replaced
+    whole, so a store that is memory mapped by another process keeps mapping the columns it loaded.
+    """
+    store_path = Path(write_directory, write_name)
+    store_path.mkdir(parents=True, exist_ok=True)
+
+    index_path = Path(store_path, "Index.txt")
+    index_path.unlink(missing_ok=True)
+
+    for name, column in columns.items():
+        replace_file(Path(store_path, f"{name}.npy"), lambda column_file: np.save(column_file, column))
+
+    index = json.dumps(index, ensure_ascii=False, indent=4, sort_keys=True).encode("utf-8")
+    replace_file(index_path, lambda index_file: index_file.write(index))
+    return store_path
+
+
+def _load_columns(store_path: Union[str, Path], names: List[str], mmap: bool) -> Tuple[dict, Dict[str, np.ndarray]]:
+    """Load the index and columns of a store, with the columns memory mapped rather than read if mmap"""
+    assert is_columnar(store_path), f"{store_path} is not a columnar store"
+    columns = {name: np.load(Path(store_path, f"{name}.npy"), mmap_mode="r" if mmap else None) for name in names}
+    return load_json(Path(store_path, "Index.txt")), columns
+
+
+class ColumnarDatabase:
+    def __init__(self, places: List[str], attributes: List[str], dates: np.ndarray, entry_keys: np.ndarray,
+                 entry_values: np.ndarray, entry_numeric: np.ndarray, has_attribute: np.ndarray, text: Dict[int, str],
+                 scalars: List[dict]):
+        """
+        A relational database of {place: {attribute: {date: value}}} with the places, attributes and dates interned to
+        their index, holding only the values that exist.
+
+        Each value is an entry keyed by the flat index of its [place, attribute, date], with the entries sorted on their
+        key so the values of any place and attribute within a range of dates are found by binary search. Numeric values
+        are held as floats in entry_values. Entries that are not numeric, such as NA, are held in text keyed by their
+        entry index, and any entry of a place that is not a dict of dates, such as its GID, is held in scalars.
+        """
+        self.places = places
+        self.attributes = attributes
+        self.dates = dates
+
+        # The sorted flat [place, attribute, date] key of each entry, its value, and True where that value is a number
+        self.entry_keys = entry_keys
+        self.entry_values = entry_values
+        self.entry_numeric = entry_numeric
+
+        # Array of [place, attribute], True if a place has a dict of dates for an attribute even if it is empty
+        self.has_attribute = has_attribute
+
+        self.text = text
+        self.scalars = scalars
+
+        # Entries without any attributes or scalars are empty, so treated as if no data existed for them
+        self.populated = np.array([len(scalars[row]) > 0 for row in range(len(places))], dtype=bool) | \
+            np.asarray(has_attribute).any(axis=1)
+
+    def __repr__(self):
+        return f"ColumnarDatabase of {len(self.places)} places, {len(self.attributes)} attributes, " \
+               f"{len(self.dates)} dates and {len(self.entry_keys)} values"
+
+    @classmethod
+    def from_relational(cls, database: dict) -> "ColumnarDatabase":
+        """Intern a loaded relational database of {place: {attribute: {date: value}}} into sorted entries"""
+        places = list(database.keys())
+        attributes = sorted({attr for entry in database.values() for attr, data in entry.items()
+                             if isinstance(data, dict)})
+        dates = np.array(sorted({int(date) for entry in database.values() for data in entry.values()
+                                 if isinstance(data, dict) for date in data}), dtype=np.int64)
+
+        date_index = {date: index for index, date in enumerate(dates.tolist())}
+        has_attribute = np.zeros((len(places), len(attributes)), dtype=bool)
+
+        entry_keys, entry_values, entry_numeric = [], [], []
+        text = {}
+        scalars = []
+        for row, entry in enumerate(database.values()):
+            scalars.append({key: value for key, value in entry.items() if not isinstance(value, dict)})
+
+            # Entries are added in place, attribute and then date order, so their keys are already sorted
+            for a, attr in enumerate(attributes):
+                data = entry.get(attr)
+                if not isinstance(data, dict):
+                    continue
+
+                has_attribute[row, a] = True
+                cell_key = (row * len(attributes) + a) * len(dates)
+                for d, value in sorted(((date_index[int(date)], value) for date, value in data.items()),
+                                       key=lambda date_value: date_value[0]):
+                    if isinstance(value, (int, float)):
+                        entry_values.append(value)
+                        entry_numeric.append(True)
+                    else:
+                        text[len(entry_keys)] = value
+                        entry_values.append(np.nan)
+                        entry_numeric.append(False)
+                    entry_keys.append(cell_key + d)
+
+        return cls(places, attributes, dates, np.array(entry_keys, dtype=np.int64),
+                   np.array(entry_values, dtype=np.float64), np.array(entry_numeric, dtype=bool), has_attribute, text,
+                   scalars)
+
+    def save(self, write_directory: Union[str, Path], write_name: str) -> Path:
+        """Write the database as a columnar store called write_name within write_directory"""
+        index = {"Places": self.places, "Attributes": self.attributes, "Scalars": self.scalars,
+                 "Text": {str(entry): value for entry, value in self.text.items()}}
+        columns = {"Dates": self.dates, "EntryKeys": self.entry_keys, "EntryValues": self.entry_values,
+                   "EntryNumeric": self.entry_numeric, "HasAttribute": self.has_attribute}
+        return _write_columns(write_directory, write_name, index, columns)
+
+    @classmethod
+    def load(cls, store_path: Union[str, Path], mmap: bool = True) -> "ColumnarDatabase":
+        """Load a columnar store, by default with its arrays memory mapped so only the values accessed are read"""
+        index, columns = _load_columns(
+            store_path, ["Dates", "EntryKeys", "EntryValues", "EntryNumeric", "HasAttribute"], mmap)
+        return cls(index["Places"], index["Attributes"], np.asarray(columns["Dates"]), columns["EntryKeys"],
+                   columns["EntryValues"], columns["EntryNumeric"], columns["HasAttribute"],
+                   {int(entry): value for entry, value in index["Text"].items()}, index["Scalars"])
+
+    def date_slice(self, date_min: int, date_max: int) -> slice:
+        """Return the slice of the date axis where date_min <= date < date_max"""
+        start, stop = np.searchsorted(self.dates, [date_min, date_max], side="left").tolist()
+        return slice(start, max(start, stop))
+
+    def _entry_ranges(self, rows: Sequence[int], attribute: int, dates: slice) -> Tuple[np.ndarray, np.ndarray]:
+        """The start and stop entry of the values of an attribute of each of rows, within the dates slice"""
+        cell_keys = (np.asarray(rows, dtype=np.int64) * len(self.attributes) + attribute) * len(self.dates)
+        return np.searchsorted(self.entry_keys, cell_keys + dates.start), \
+            np.searchsorted(self.entry_keys, cell_keys + dates.stop)
+
+    def block(self, rows: Sequence[int], attribute: int, dates: slice) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Return dense [row, date] arrays of the values of an attribute for only the places at rows and the dates within
+        the dates slice, alongside masks that are True where a value is present and where it is numeric
+        """
+        starts, stops = self._entry_ranges(rows, attribute, dates)
+        lengths = stops - starts
+        entries = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        row_positions = np.repeat(np.arange(len(lengths)), lengths)
+        date_positions = np.asarray(self.entry_keys[entries]) % len(self.dates) - dates.start
+
+        shape = (len(lengths), dates.stop - dates.start)
+        values = np.full(shape, np.nan, dtype=np.float64)
+        present = np.zeros(shape, dtype=bool)
+        numeric = np.zeros(shape, dtype=bool)
+        values[row_positions, date_positions] = self.entry_values[entries]
+        present[row_positions, date_positions] = True
+        numeric[row_positions, date_positions] = self.entry_numeric[entries]
+        return values, present, numeric
+
+    def text_value(self, row: int, attribute: int, date: int) -> str:
+        """Return the non numeric value held at a given place, attribute and date"""
+        key = (row * len(self.attributes) + attribute) * len(self.dates) + date
+        return self.text[int(np.searchsorted(self.entry_keys, key))]
+
+    def entry(self, row: int, attribute_columns: Optional[List[int]] = None, dates: Optional[slice] = None) -> dict:
+        """
+        Rebuild the {attribute: {date: value}} entry of a place, as it would be in a relational json database, of the
+        attributes at attribute_columns and dates within the dates slice if given
+        """
+        attribute_columns = range(len(self.attributes)) if attribute_columns is None else attribute_columns
+        dates = slice(0, len(self.dates)) if dates is None else dates
+
+        entry = dict(self.scalars[row])
+        for a in attribute_columns:
+            if not self.has_attribute[row, a]:
+                continue
+
+            starts, stops = self._entry_ranges([row], a, dates)
+            entries = range(int(starts[0]), int(stops[0]))
+            date_indexes = (np.asarray(self.entry_keys[entries.start:entries.stop]) % len(self.dates)).tolist()
+            values = self.entry_values[entries.start:entries.stop].tolist()
+            numeric = self.entry_numeric[entries.start:entries.stop].tolist()
+            entry[self.attributes[a]] = {str(self.dates[d]): value if is_numeric else self.text[e]
+                                         for e, d, value, is_numeric in zip(entries, date_indexes, values, numeric)}
+        return entry
+
+
+class ColumnarWeights:
+    def __init__(self, places: List[str], change_offsets: np.ndarray, change_dates: np.ndarray,
+                 weight_offsets: np.ndarray, weight_places: List[str], weight_place_index: np.ndarray,
+                 weights: np.ndarray):
+        """
+        Weights by dates from AssignWeights, of {place: {date: {weight_place: weight}}}, held as flat arrays. This acts
+        as a compiled plan for weighting, so that the dates, periods and places of each change are only derived once.
+
+        The changes of places[i] are change_offsets[i]:change_offsets[i + 1] of change_dates, and the weights of change
+        c are weight_offsets[c]:weight_offsets[c + 1] of weights, with their places interned into weight_places.
+        """
+        self.places = places
+        self.change_offsets = change_offsets
+        self.change_dates = change_dates
+        self.weight_offsets = weight_offsets
+        self.weight_places = weight_places
+        self.weight_place_index = weight_place_index
+        self.weights = weights
+
+        # The date each change is superseded by the next change of its place, or -1 for the last change of a place
+        self.change_ends = np.append(np.asarray(change_dates)[1:], -1).astype(np.int64)
+        self.change_ends[np.asarray(change_offsets)[1:] - 1] = -1
+
+    def __repr__(self):
+        return f"ColumnarWeights of {len(self.places)} places with {len(self.change_dates)} changes"
+
+    @classmethod
+    def from_weights(cls, weights_dates: dict) -> "ColumnarWeights":
+        """Intern loaded weights by dates, keeping the order of the places, changes and weight places"""
+        interned = {}
+        change_offsets, change_dates, weight_offsets, weight_place_index, weights = [0], [], [0], [], []
+        for place_weights in weights_dates.values():
+            for date, date_weights in place_weights.items():
+                change_dates.append(int(date))
+                for weight_place, weight in date_weights.items():
+                    weight_place_index.append(interned.setdefault(weight_place, len(interned)))
+                    weights.append(weight)
+                weight_offsets.append(len(weights))
+            change_offsets.append(len(change_dates))
+
+        return cls(list(weights_dates.keys()), np.array(change_offsets, dtype=np.int64),
+                   np.array(change_dates, dtype=np.int64), np.array(weight_offsets, dtype=np.int64), list(interned),
+                   np.array(weight_place_index, dtype=np.int64), np.array(weights, dtype=np.float64))
+
+    def save(self, write_directory: Union[str, Path], write_name: str) -> Path:
+        """Write the weights as a columnar store called write_name within write_directory"""
+        columns = {"ChangeOffsets": self.change_offsets, "ChangeDates": self.change_dates,
+                   "WeightOffsets": self.weight_offsets, "WeightPlaceIndex": self.weight_place_index,
+                   "Weights": self.weights}
+        return _write_columns(write_directory, write_name, {"Places": self.places, "WeightPlaces": self.weight_places},
+                              columns)
+
+    @classmethod
+    def cached(cls, weights_path: Union[str, Path], plan_directory: Union[str, Path]) -> "ColumnarWeights":
+        """
+        Return the weights of a weights by dates json, from a store within plan_directory named after the hash of the
+        json if one exists. Otherwise the weights are interned and then saved there, so later runs against the same
+        weights reuse them.
+
+        A plan is saved to a temporary directory and moved into place whole, so a run never sees another's partially
+        written plan. If several runs compile the same plan at once, the first to finish keeps its plan and the others
+        discard their copy. A plan is kept for every distinct weights json, see prune_weight_plans.
+        """
+        plan_path = Path(plan_directory, file_hash(weights_path))
+        if is_columnar(plan_path):
+            print(f"Loading cached weight plan {plan_path.name}")
+            return cls.load(plan_path)
+
+        weights = cls.from_weights(load_json(weights_path))
+        temporary_path = weights.save(plan_directory, f"{plan_path.name}.{os.getpid()}.tmp")
+        try:
+            # A plan directory without an index was left by a run that failed whilst writing it
+            if plan_path.exists() and not is_columnar(plan_path):
+                shutil.rmtree(plan_path, ignore_errors=True)
+            os.replace(temporary_path, plan_path)
+        except OSError:
+            print(f"Weight plan {plan_path.name} was cached by another run, discarding this copy")
+        finally:
+            shutil.rmtree(temporary_path, ignore_errors=True)
+        return weights
+
+    @classmethod
+    def load(cls, store_path: Union[str, Path], mmap: bool = True) -> "ColumnarWeights":
+        """Load a columnar weights store"""
+        index, columns = _load_columns(
+            store_path, ["ChangeOffsets", "ChangeDates", "WeightOffsets", "WeightPlaceIndex", "Weights"], mmap)
+        return cls(index["Places"], columns["ChangeOffsets"], columns["ChangeDates"], columns["WeightOffsets"],
+                   index["WeightPlaces"], columns["WeightPlaceIndex"], columns["Weights"])
+
+    def changes(self, place_index: int) -> range:
+        """The indexes of the changes of a place"""
+        return range(int(self.change_offsets[place_index]), int(self.change_offsets[place_index + 1]))
+
+    def period(self, change: int, date_max: int) -> Tuple[int, int]:
+        """
+        The period a change applies to, from its date until the next change of its place or until date_max if it is
+        the last change of its place
+        """
+        change_end = int(self.change_ends[change])
+        return int(self.change_dates[change]), int(date_max) if change_end < 0 else change_end
+
+    def change_weights(self, change: int) -> Tuple[List[str], List[float]]:
+        """The places and weights of a change"""
+        start, stop = int(self.weight_offsets[change]), int(self.weight_offsets[change + 1])
+        return [self.weight_places[i] for i in self.weight_place_index[start:stop].tolist()], \
+            self.weights[start:stop].tolist()
+
+    def as_weights_dates(self) -> dict:
+        """Rebuild the {place: {date: {weight_place: weight}}} weights by dates dict"""
+        weights_dates = {}
+        for place_index, place in enumerate(self.places):
+            weights_dates[place] = {}
+            for change in self.changes(place_index):
+                weight_places, weights = self.change_weights(change)
+                weights_dates[place][str(self.change_dates[change])] = dict(zip(weight_places, weights))
+        return weights_dates
+
+
+def prune_weight_plans(plan_directory: Union[str, Path], weights_paths: List[Union[str, Path]]) -> List[str]:
+    """
+    Remove the cached weight plans within plan_directory that were not compiled from any of weights_paths. A plan is
+    cached for every distinct weights json weighted against, so plan_directory grows until it is pruned.
+
+    :param plan_directory: The directory of cached weight plans, by default a WeightPlans directory beside the weights
+    :param weights_paths: The weights by dates jsons whose plans should be kept
+    :return: The hashes of the plans removed
+    """
+    keep = {file_hash(weights_path) for weights_path in weights_paths}
+    removed = [plan_path.name for plan_path in Path(plan_directory).iterdir()
+               if is_columnar(plan_path) and plan_path.name not in keep]
+    for plan_name in removed:
+        shutil.rmtree(Path(plan_directory, plan_name), ignore_errors=True)
+    return removed
+
+
+def write_columnar_database(relational_path: Union[str, Path], write_directory: Union[str, Path],
+                            write_name: Optional[str] = None) -> Path:
+    """
+    Convert a relational json database into a columnar store that WeightExternal can memory map and weight with array
+    arithmetic. Numeric values are held as floats, in keeping with the databases written by FormatRelational.
+
+    :param relational_path: The path to the relational json database
+    :param write_directory: The directory to write the store within
+    :param write_name: The name of the store, defaults to the name of the relational database
+    :return: The path to the store
+    """
+    print(f"Loading data...")
+    return ColumnarDatabase.from_relational(load_json(relational_path)).save(
+        write_directory, write_name if write_name else Path(relational_path).stem)
+
+
+def write_columnar_weights(weights_path: Union[str, Path], write_directory: Union[str, Path],
+                           write_name: Optional[str] = None) -> Path:
+    """
+    Convert a weights by dates json from AssignWeights into a columnar store
+
+    :param weights_path: The path to the weights by dates json
+    :param write_directory: The directory to write the store within
+    :param write_name: The name of the store, defaults to the name of the weights file
+    :return: The path to the store
+    """
+    return ColumnarWeights.from_weights(load_json(weights_path)).save(
+        write_directory, write_name if write_name else Path(weights_path).stem)
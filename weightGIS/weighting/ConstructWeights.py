@@ -1,12 +1,19 @@
+from weightGIS.weighting.StreamWeights import completed_places, iterate_weights, write_weights_line
+from weightGIS.ShapeIndex import LazyShapeIndex, ShapeIndex, cached_fingerprint, load_shapefile
 from weightGIS.Errors import BaseNameNotFound, NoSubUnitWeightIndex
+from weightGIS.Parallel import chunk_indexes, parallel_map
+from weightGIS.Overlaps import indexed_overlaps
 
-from miscSupports import directory_iterator, validate_path, write_json
+from miscSupports import directory_iterator, validate_path, write_json, load_json
 from shapely.geometry import LineString, Polygon, MultiPolygon
-from shapeObject import ShapeObject, multi_to_poly
+from typing import Iterator, List, Optional, Tuple, Union
 from shapely.ops import split as shp_split
-from typing import List, Union, Optional
+from shapely import get_parts, STRtree
+from collections import OrderedDict
 from dataclasses import dataclass
 from pathlib import Path
+import json
+import os
 import re
 
 
@@ -33,11 +40,21 @@ class PreValidateConstructWeights:
         self._sub_units, self.gid, = subunits, gid
         self.weight_index = self._set_weight_index(weight_index)
 
+        # The path of each file loaded, so they can be fingerprinted when changes to them need to be detected between
+        # runs
+        self.fingerprint_paths = {"Base": None, "SubUnits": None, "Shapefiles": {}}
+
     def __call__(self):
         """Validate the starting parameters of ConstructWeights"""
 
-        # Isolate all the shapefiles to investigate changes between
-        shape_files = [ShapeObject(f"{self._shp_path}/{file}") for file in self._isolate_shapefiles()]
+        # Isolate all the shapefiles to investigate changes between, indexing each so overlaps can be searched for.
+        # Their geometry is only materialised as it is used, so every year's polygons are not resident at once
+        shapefile_names = self._isolate_shapefiles()
+        shape_files = [LazyShapeIndex(Path(self._shp_path, file)) for file in shapefile_names]
+
+        self.fingerprint_paths["Base"] = Path(self._shp_path, self._base_name)
+        self.fingerprint_paths["Shapefiles"] = {re.sub(r'\D', "", file): Path(self._shp_path, file)
+                                                for file in shapefile_names}
 
         # If we are allowing for sub unit population weighting, load that shapefile as well
         if self._sub_units:
@@ -46,7 +63,7 @@ class PreValidateConstructWeights:
             sub_units = None
 
         # Return the base shapefile, the other shapefiles, and the sub-unit shapefile
-        return ShapeObject(f"{self._shp_path}/{self._base_name}"), shape_files, sub_units
+        return ShapeIndex.from_shapefile(Path(self._shp_path, self._base_name)), shape_files, sub_units
 
     def _set_weight_index(self, weight_index):
         """If a weight index has not be declared raise an exception"""
@@ -75,28 +92,34 @@ class PreValidateConstructWeights:
         """Load the Sub unit file, if it was requested, and validate a weight_index was set if loaded"""
         # If the subunit name is a path, load it from that path
         if Path(self._sub_units).exists():
-            sub_units = ShapeObject(self._sub_units)
+            sub_unit_path = Path(self._sub_units)
 
         # Otherwise check if it is a file name that exists in the project directory
         elif Path(self._working_dir, self._sub_units).exists():
-            sub_units = ShapeObject(f"{self._working_dir}/{self._sub_units}")
+            sub_unit_path = Path(self._working_dir, self._sub_units)
 
         else:
             raise FileNotFoundError(f"Sub unit weighting specified but no file called {self._sub_units} found in "
                                     f"{self._working_dir}")
 
+        _, polygons, records = load_shapefile(sub_unit_path)
+        self.fingerprint_paths["SubUnits"] = sub_unit_path
+
         # Area interactions don't work with multi-polygons, so split each one based on area of sub poly to multi-polygon
         return [SubPoly(str(rec[self.gid]), p, float(rec[self.weight_index]) * (p.area / poly.area))
-                for poly, rec in zip(sub_units.polygons, sub_units.records) for p in multi_to_poly(poly)]
+                for poly, rec in zip(polygons, records) for p in get_parts(poly)]
 
 
 class ConstructWeights:
     def __init__(self, working_directory: Union[str, Path], base_name: str, gid: int, name_indexes: List[int],
                  subunits: Optional[Union[str, Path]] = None, shapefile_folder="Shapefiles", cut_off=100,
-                 weight_index: Optional[int] = None):
+                 weight_index: Optional[int] = None, partition_cache: int = 1024):
         """
         This class takes a set of shapefiles and creates a weighted json based on either the overlapping area or
         underlying population.
+
+        When weighting by sub unit population, the interior partition of a match shape is the same for every base shape
+        it overlaps, so up to partition_cache of the most recently used partitions are kept rather than recomputed.
         """
         self._gid = gid
         self._name_indexes = name_indexes
@@ -106,7 +129,52 @@ class ConstructWeights:
         val = PreValidateConstructWeights(working_directory, shapefile_folder, base_name, subunits, gid, weight_index)
         self.base, self.shapefiles, self.sub_units = val()
 
-    def construct_base_weights(self, write_dir: Union[str, Path], write_name: str = 'BaseWeights') -> None:
+        # The files and parameters used, which are fingerprinted so an incremental run can determine what needs to be
+        # recomputed. Fingerprints are only calculated once an incremental run or writing them needs them
+        self._fingerprint_paths = val.fingerprint_paths
+        self._parameters = [gid, name_indexes, cut_off, weight_index]
+        self._file_fingerprints = None
+
+        # Index the sub units, and set up the (year, match gid) keyed cache of interior partitions
+        self._sub_unit_tree = self._index_sub_units()
+        self._partition_cache = partition_cache
+        self._partitions = OrderedDict()
+
+    def __getstate__(self):
+        """The sub unit tree and partition cache are rebuilt rather than shipped to worker processes"""
+        state = self.__dict__.copy()
+        state["_sub_unit_tree"] = None
+        state["_partitions"] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._sub_unit_tree = self._index_sub_units()
+
+    @property
+    def _fingerprints(self) -> dict:
+        """
+        The fingerprints of the files and parameters used, calculated when first required. Files that have not been
+        touched since they were last fingerprinted reuse their cached fingerprint, see cached_fingerprint.
+        """
+        if self._file_fingerprints is None:
+            paths = self._fingerprint_paths
+            self._file_fingerprints = {
+                "Base": cached_fingerprint(paths["Base"]),
+                "SubUnits": None if paths["SubUnits"] is None else cached_fingerprint(paths["SubUnits"]),
+                "Shapefiles": {year: cached_fingerprint(path) for year, path in paths["Shapefiles"].items()}}
+        return {**self._file_fingerprints, "Parameters": self._parameters}
+
+    def _index_sub_units(self) -> Optional[STRtree]:
+        """Construct a STRtree of the sub unit polygons, if sub unit weighting is being used"""
+        if self.sub_units:
+            return STRtree([sub.poly for sub in self.sub_units])
+        else:
+            return None
+
+    def construct_base_weights(self, write_dir: Union[str, Path], write_name: str = 'BaseWeights',
+                               workers: int = 1, checkpoint: int = 100, resume: bool = False,
+                               incremental: bool = False, stream: bool = False) -> None:
         """
         Construct the base weights for a set of shapefiles.
 
@@ -114,46 +182,245 @@ class ConstructWeights:
         shapefile to calculate anm area weight. If sub unit searching is enabled, it is also possible to use under-
         lapping geometery to calculate a sub unit weight. This is done for every shape in the base shapefile and then
         returned
-        """
-        base_weights = {f"{rec[self._gid]}__{self._construct_name(rec)}": [] for rec in self.base.records}
-        for c, (shape, record) in enumerate(zip(self.base.polygons, self.base.records)):
-            print(f"{record[self._gid]}: {c + 1} / {len(self.base.polygons)}")
 
-            match_weights = {file: [] for file in [re.sub(r'\D', "", file.file_name) for file in self.shapefiles]}
-            for index, match_shape_file in enumerate(self.shapefiles):
+        Each base shape is independent of the others, so if workers is greater than one the base shapes are partitioned
+        into chunks and processed across a pool of that many processes.
+
+        Completed base places are appended to a {write_name}_Checkpoint.jsonl file in write_dir every checkpoint
+        places. If a run fails, setting resume to True will load the places already completed and only construct the
+        remaining ones. The checkpoint file is removed once the weights have been written.
 
-                # Set the weight from overlapping area
-                weights = self._polygon_area_weights(shape, match_shape_file)
+        The fingerprint of each file used is written alongside the weights to {write_name}_Fingerprints. If incremental
+        is True and weights already exist, only the years whose shapefile has changed since are recomputed and patched
+        into the existing weights. If the base or sub unit shapefile, or the parameters, have changed then every year
+        is recomputed.
 
-                # If set, set the weight from underling sub unit population
-                if self.sub_units:
-                    weights = {gid: self._sub_weight(shape, overlap_values) for gid, overlap_values in weights.items()}
+        If stream is True, each place is written as a line of {write_name}.jsonl as it is completed rather than held in
+        memory and written as a single json at the end, which AssignWeights and AdjustWeights can read lazily.
+        """
+        years, previous_weights = self._changed_years(write_dir, write_name, stream) if incremental else (None, {})
+
+        if stream:
+            self._stream_weights(write_dir, write_name, workers, checkpoint, resume, years, previous_weights)
+        else:
+            self._write_weights(write_dir, write_name, workers, checkpoint, resume, years, previous_weights)
 
-                match_weights[re.sub(r'\D', "", match_shape_file.file_name)] = weights
+        write_json(self._fingerprints, write_dir, f"{write_name}_Fingerprints")
 
-            base_weights[f"{record[self._gid]}__{self._construct_name(record)}"] = match_weights
+    def _write_weights(self, write_dir: Union[str, Path], write_name: str, workers: int, checkpoint: int,
+                       resume: bool, years: Optional[List[str]], previous_weights: dict) -> None:
+        """
+        Construct the weights of every base place, checkpointing them as we go, and then write them as a single json
+        """
+        checkpoint_path = Path(write_dir, f"{write_name}_Checkpoint.jsonl")
+        if resume:
+            place_weights = self._load_checkpoint(checkpoint_path)
+            print(f"Resuming from {len(place_weights)} completed places")
+        else:
+            place_weights = {}
+            checkpoint_path.unlink(missing_ok=True)
+
+        # Construct the weights of the places that have not been completed, checkpointing them as we go
+        remaining = [i for i, record in enumerate(self.base.records) if self._place_key(record) not in place_weights]
+        completed = []
+        for index, match_weights in self._weight_places(remaining, workers, years):
+            place_key = self._place_key(self.base.records[index])
+            place_weights[place_key] = match_weights
+            completed.append(place_key)
+
+            if len(completed) >= checkpoint:
+                self._write_checkpoint(checkpoint_path, completed, place_weights)
+                completed = []
+        self._write_checkpoint(checkpoint_path, completed, place_weights)
+
+        # Patch any years that did not need to be recomputed in from the previous weights
+        base_weights = {}
+        for record in self.base.records:
+            place_key = self._place_key(record)
+            base_weights[place_key] = {**previous_weights.get(place_key, {}), **place_weights[place_key]}
 
         write_json(base_weights, write_dir, write_name)
+        checkpoint_path.unlink(missing_ok=True)
+
+    def _stream_weights(self, write_dir: Union[str, Path], write_name: str, workers: int, checkpoint: int,
+                        resume: bool, years: Optional[List[str]], previous_weights: dict) -> None:
+        """
+        Construct the weights of every base place, writing each place as a line of {write_name}.jsonl as soon as it is
+        completed so that no place is retained in memory. The written lines act as the checkpoint, and are flushed to
+        disk every checkpoint places.
+
+        When only some years are being reconstructed the lines are written to a .partial file, which replaces the
+        previous weights once every place is complete, so the previous weights remain intact if the run fails.
+        """
+        weights_path = Path(write_dir, f"{write_name}.jsonl")
+        write_path = weights_path if years is None else weights_path.with_suffix(".jsonl.partial")
 
-    def _polygon_area_weights(self, current_shape: Union[Polygon, MultiPolygon], match_shape_file: ShapeObject) -> dict:
+        if resume:
+            completed = completed_places(write_path)
+            print(f"Resuming from {len(completed)} completed places")
+        else:
+            completed = set()
+            write_path.unlink(missing_ok=True)
+
+        remaining = [i for i, record in enumerate(self.base.records) if self._place_key(record) not in completed]
+        with open(write_path, "a", encoding="utf-8") as weights_file:
+            for count, (index, match_weights) in enumerate(self._weight_places(remaining, workers, years), 1):
+                place_key = self._place_key(self.base.records[index])
+
+                # Patch any years that did not need to be recomputed in from the previous weights
+                write_weights_line(weights_file, place_key, {**previous_weights.pop(place_key, {}), **match_weights})
+                if count % checkpoint == 0:
+                    weights_file.flush()
+
+        if write_path != weights_path:
+            os.replace(write_path, weights_path)
+
+    def _changed_years(self, write_dir: Union[str, Path], write_name: str,
+                       stream: bool) -> Tuple[Optional[List[str]], dict]:
+        """
+        Compare the current fingerprints to those of a previous run, returning the years that need to be recomputed and
+        the previous weights of the years that do not. If there is no previous run, or the base, sub units or
+        parameters have changed, then None is returned for the years so that every year is recomputed.
+        """
+        weights_path = Path(write_dir, f"{write_name}.jsonl" if stream else f"{write_name}.txt")
+        fingerprints_path = Path(write_dir, f"{write_name}_Fingerprints.txt")
+        if not (weights_path.exists() and fingerprints_path.exists()):
+            print("No previous weights or fingerprints found, constructing all years")
+            return None, {}
+
+        previous = load_json(fingerprints_path)
+        current = json.loads(json.dumps(self._fingerprints))
+        if any(previous.get(key) != current[key] for key in ("Base", "SubUnits", "Parameters")):
+            print("Base, sub units or parameters have changed, constructing all years")
+            return None, {}
+
+        years = [year for year, fingerprint in current["Shapefiles"].items()
+                 if previous["Shapefiles"].get(year) != fingerprint]
+        print(f"Constructing the changed years of {years}")
+
+        # Json will have turned any int gids into strings, so restore the gids of the unchanged years from their records
+        gid_types = {re.sub(r'\D', "", file.file_name): {str(rec[self._gid]): rec[self._gid] for rec in file.records}
+                     for file in self.shapefiles}
+        previous_weights = {place: {year: {gid_types[year][gid]: values for gid, values in year_weights.items()}
+                                    for year, year_weights in match_weights.items()
+                                    if year in current["Shapefiles"] and year not in years}
+                            for place, match_weights in iterate_weights(weights_path)}
+        return years, previous_weights
+
+    def _place_key(self, record: List[str]) -> str:
+        """The key of a base place within the base weights, gid__name"""
+        return f"{record[self._gid]}__{self._construct_name(record)}"
+
+    def _weight_places(self, indexes: List[int], workers: int,
+                       years: Optional[List[str]] = None) -> Iterator[Tuple[int, dict]]:
+        """Yield the index and match weights of each base shape in indexes, in order, as they are completed"""
+        if workers > 1:
+            yield from self._parallel_weights(indexes, workers, years)
+        else:
+            for index in indexes:
+                print(f"{self.base.records[index][self._gid]}: {index + 1} / {len(self.base.polygons)}")
+                yield index, self._match_weights(self.base.polygons[index], years)
+
+    def _match_weights(self, shape: Union[Polygon, MultiPolygon], years: Optional[List[str]] = None) -> dict:
+        """
+        Calculate the weights of each overlapping shape in each match shapefile for a given base shape. If years is
+        provided, only the match shapefiles of those years are weighted.
+        """
+        match_shapefiles = [file for file in self.shapefiles
+                            if years is None or re.sub(r'\D', "", file.file_name) in years]
+
+        match_weights = {file: [] for file in [re.sub(r'\D', "", file.file_name) for file in match_shapefiles]}
+        for index, match_shape_file in enumerate(match_shapefiles):
+            year = re.sub(r'\D', "", match_shape_file.file_name)
+
+            # Set the weight from overlapping area
+            weights = self._polygon_area_weights(shape, match_shape_file)
+
+            # If set, set the weight from underling sub unit population
+            if self.sub_units:
+                weights = {gid: self._sub_weight(shape, overlap_values, year, gid)
+                           for gid, overlap_values in weights.items()}
+
+            match_weights[year] = weights
+        return match_weights
+
+    def _parallel_weights(self, indexes: List[int], workers: int,
+                          years: Optional[List[str]] = None) -> Iterator[Tuple[int, dict]]:
+        """
+        Calculate the match weights of the base shapes in indexes across a pool of processes.
+
+        Each process receives a copy of this constructor once, when it starts, with the geometry shipped as WKB via
+        ShapeIndex. Tasks are then just chunks of base shape indexes, and the results are yielded in the order of
+        indexes.
+        """
+        chunks = chunk_indexes(indexes, workers)
+        chunk_weights = parallel_map(self, ConstructWeights._chunk_match_weights, [(chunk, years) for chunk in chunks],
+                                     workers)
+        for chunk, weights in zip(chunks, chunk_weights):
+            print(f"{chunk[-1] + 1} / {len(self.base.polygons)}")
+            yield from zip(chunk, weights)
+
+    def _chunk_match_weights(self, indexes: List[int], years: Optional[List[str]]) -> List[dict]:
+        """Calculate the match weights for a chunk of base shape indexes, within a worker process"""
+        return [self._match_weights(self.base.polygons[i], years) for i in indexes]
+
+    @staticmethod
+    def _write_checkpoint(checkpoint_path: Path, completed: List[str], place_weights: dict) -> None:
+        """
+        Append the completed places to the checkpoint file, one json line per place.
+
+        Match gids may be ints, which json would turn into strings if they were dict keys, so each year's weights are
+        stored as [gid, weight] pairs so the types are restored exactly on resume.
+        """
+        with open(checkpoint_path, "a", encoding="utf-8") as checkpoint_file:
+            for place_key in completed:
+                weights = {year: [[gid, values] for gid, values in year_weights.items()]
+                           for year, year_weights in place_weights[place_key].items()}
+                checkpoint_file.write(json.dumps({"Place": place_key, "Weights": weights}, ensure_ascii=False) + "\n")
+
+    @staticmethod
+    def _load_checkpoint(checkpoint_path: Path) -> dict:
+        """
+        Load the places completed within a checkpoint file, if it exists. A line that was only partially written when
+        a run failed is ignored, so that place is constructed again.
+        """
+        place_weights = {}
+        if not checkpoint_path.exists():
+            return place_weights
+
+        with open(checkpoint_path, encoding="utf-8") as checkpoint_file:
+            for line in checkpoint_file:
+                try:
+                    place = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                place_weights[place["Place"]] = {year: {gid: values for gid, values in year_weights}
+                                                 for year, year_weights in place["Weights"].items()}
+        return place_weights
+
+    def _polygon_area_weights(self, current_shape: Union[Polygon, MultiPolygon], match_shape_file: ShapeIndex) -> dict:
         """
         Calculates the weights relative to the base years current_shape in terms of area for each shape in the
-        match_shape_file which has an overlap
+        match_shape_file which has an overlap greater than the cut off. Overlaps are found via the match_shape_file's
+        index, with the overlapping areas of all candidates calculated at once.
         """
-        area_weights = {record[self._gid]: self._calculate_area_weight(current_shape, match_shape, record)
-                        for match_shape, record in zip(match_shape_file.polygons, match_shape_file.records)}
-        return {gid: weights for gid, weights in area_weights.items() if weights}
+        _, match_indexes, overlap_areas = indexed_overlaps(current_shape, match_shape_file, self._cut_off)
+        return {match_shape_file.records[i][self._gid]: self._calculate_area_weight(
+            overlap_area, match_shape_file.polygons[i], match_shape_file.records[i])
+            for i, overlap_area in zip(match_indexes, overlap_areas)}
 
-    def _calculate_area_weight(self, current_shape: Union[Polygon, MultiPolygon],
-                               match_shape: Union[Polygon, MultiPolygon], record: List[str]):
+    def _calculate_area_weight(self, overlap_area: float, match_shape: Union[Polygon, MultiPolygon],
+                               record: List[str]) -> dict:
         """
-        If the overlap is greater than the cut off, return a dict with Name, Area Weight, Population Stub, and
-        Match Shape
+        Return a dict with Name, Area Weight, Population Stub, and Match Shape if needed, for an overlap
         """
-        overlap_area = current_shape.intersection(match_shape).area
-        if overlap_area > self._cut_off:
-            return {'Name': self._construct_name(record), 'Area': (overlap_area / match_shape.area) * 100,
-                    'Population': None, 'Match': match_shape}
+        area_weight = {'Name': self._construct_name(record), 'Area': (overlap_area / match_shape.area) * 100,
+                       'Population': None}
+
+        # The match shape is only needed, and then popped, when calculating sub unit weights
+        if self.sub_units:
+            area_weight['Match'] = match_shape
+        return area_weight
 
     def _construct_name(self, record: List[str]) -> str:
         """
@@ -161,7 +428,7 @@ class ConstructWeights:
         """
         return "_".join([record[i] for i in self._name_indexes])
 
-    def _sub_weight(self, base_shape: Union[Polygon, MultiPolygon], overlap_values: dict) -> dict:
+    def _sub_weight(self, base_shape: Union[Polygon, MultiPolygon], overlap_values: dict, year: str, gid) -> dict:
         """
         Calculates and returns the sub unit weight for each overlapping shape
 
@@ -172,7 +439,7 @@ class ConstructWeights:
 
         """
         if overlap_values['Area'] != 100:
-            interior_polys = self._sub_poly_weight(self.sub_units, overlap_values['Match'])
+            interior_polys = self._interior_partition(year, gid, overlap_values['Match'])
             base_polys = self._sub_poly_weight(interior_polys, base_shape)
             weight = (sum(i.weight for i in base_polys) / sum(i.weight for i in interior_polys) * 100)
 
@@ -185,13 +452,38 @@ class ConstructWeights:
         overlap_values.pop('Match', None)
         return overlap_values
 
-    def _sub_poly_weight(self, sub_units: List[SubPoly], main_polygon: Union[Polygon, MultiPolygon]):
-        """Calculate the population weight from subunit weights"""
+    def _interior_partition(self, year: str, gid, match_shape: Union[Polygon, MultiPolygon]) -> List[SubPoly]:
+        """
+        Return the sub unit partition of the interior of a match shape, from the cache if this year's gid has been
+        partitioned recently, otherwise calculating it and evicting the least recently used partition if the cache is
+        full.
+        """
+        key = (year, gid)
+        if key in self._partitions:
+            self._partitions.move_to_end(key)
+            return self._partitions[key]
+
+        interior_polys = self._sub_poly_weight(self.sub_units, match_shape, self._sub_unit_tree)
+        self._partitions[key] = interior_polys
+        if len(self._partitions) > self._partition_cache:
+            self._partitions.popitem(last=False)
+        return interior_polys
+
+    def _sub_poly_weight(self, sub_units: List[SubPoly], main_polygon: Union[Polygon, MultiPolygon],
+                         sub_unit_tree: Optional[STRtree] = None):
+        """
+        Calculate the population weight from subunit weights. If a tree of the sub_units is provided, only the sub units
+        with a bounding box that intersects each polygon are considered.
+        """
         interior_polys = []
-        for poly in multi_to_poly(main_polygon):
+        for poly in get_parts(main_polygon):
 
-            # Isolate the valid sub polys
-            valid_subs = [sub for sub in sub_units if poly.intersection(sub.poly).area > self._cut_off]
+            # Isolate the candidate sub polys, in their original order, and then the valid sub polys from these
+            if sub_unit_tree is not None:
+                candidates = [sub_units[i] for i in sorted(sub_unit_tree.query(poly).tolist())]
+            else:
+                candidates = sub_units
+            valid_subs = [sub for sub in candidates if poly.intersection(sub.poly).area > self._cut_off]
 
             # For each valid sub polygon
             for sub_poly in valid_subs:
@@ -200,7 +492,7 @@ class ConstructWeights:
                 for sub_poly_cut in self._hole_punch_sub_unit(poly, sub_poly):
 
                     # Split the polygon by the exterior line of the polygon
-                    for p in shp_split(sub_poly_cut.poly, LineString(poly.exterior)):
+                    for p in shp_split(sub_poly_cut.poly, LineString(poly.exterior)).geoms:
 
                         # If this split shape is within poly
                         intersection_area = poly.intersection(p).area
@@ -220,7 +512,7 @@ class ConstructWeights:
         for hole in current_polygon.interiors:
             if Polygon(hole).intersection(split_poly.poly).area > self._cut_off:
                 changes_from_holes = True
-                split_poly_hole_punched = shp_split(split_poly.poly, LineString(hole))
+                split_poly_hole_punched = shp_split(split_poly.poly, LineString(hole)).geoms
 
                 # Now we only isolate the parts that are within the overlap from the cut
                 for hole_cut_poly in split_poly_hole_punched:
@@ -0,0 +1,146 @@
+from weightGIS.weighting.ColumnarStore import ColumnarDatabase, ColumnarWeights
+
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from scipy.sparse import csr_matrix
+import numpy as np
+
+
+class SparseWeights:
+    def __init__(self, weights: ColumnarWeights, database: ColumnarDatabase,
+                 search_row: Callable[[str], Optional[int]], date_max: int, place_indexes: Iterable[int],
+                 attribute_columns: Optional[Sequence[int]] = None,
+                 date_slice: Optional[Callable[[int, int], slice]] = None):
+        """
+        Compiles weights by dates into a sparse matrix per date period, of the weight of each source place of the
+        database in each change that covers that period.
+
+        Weighting is linear, so the weighted values of every change within a period are a single sparse matrix
+        multiply of the source places' values of an attribute. Changes of a single place keep its non numeric values,
+        and are weighted by a direct multiply rather than through a matrix.
+
+        :param weights: The weights by dates
+        :param database: The database to weight
+        :param search_row: Returns the database row of a place, or None if it has no data
+        :param date_max: The end date of the last change of each place
+        :param place_indexes: The indexes of the places within weights to compile
+        :param attribute_columns: The indexes of the attributes of the database to weight, defaults to all of them
+        :param date_slice: Returns the slice of the date axis of a change's dates, defaults to database.date_slice
+        """
+        self._database = database
+        self._attribute_columns = range(len(database.attributes)) if attribute_columns is None else attribute_columns
+        date_slice = database.date_slice if date_slice is None else date_slice
+
+        # Changes grouped by the (start, stop) of their slice of the database's date axis
+        self._single: Dict[Tuple[int, int], List[Tuple[int, int, float]]] = {}
+        self._multiple: Dict[Tuple[int, int], List[Tuple[int, List[int], List[float], List[str]]]] = {}
+
+        for place_index in place_indexes:
+            for change in weights.changes(place_index):
+                date_min, date_max_change = weights.period(change, date_max)
+                dates = date_slice(date_min, date_max_change)
+                period = (dates.start, dates.stop)
+
+                weight_places, place_weights = weights.change_weights(change)
+                rows = [search_row(place) for place in weight_places]
+                valid = [row for row in rows if row is not None]
+
+                if len(weight_places) == 1:
+                    if len(valid) == 1:
+                        self._single.setdefault(period, []).append((change, valid[0], place_weights[0]))
+                    else:
+                        print(f"Warning: No data found for {weight_places[0]}")
+
+                elif len(valid) == len(weight_places):
+                    self._multiple.setdefault(period, []).append((change, rows, place_weights, weight_places))
+
+                else:
+                    print(f"Warning: Found {len(valid)} out of {len(weight_places)} places for "
+                          f"{weights.places[place_index]}'s weighted places of: {weight_places}\n"
+                          f"       : Data from {date_min}-{date_max_change} will be dropped\n")
+
+    def __repr__(self):
+        return f"SparseWeights of {len(self._single) + len(self._multiple)} date periods"
+
+    def weight(self) -> Tuple[Dict[int, Dict[str, dict]], Dict[int, Dict[str, dict]]]:
+        """
+        Weight every compiled change for every attribute.
+
+        :return: A dict of {change: {attribute: {date: value}}} of the weighted values, and a dict of
+            {change: {attribute: report}} of the non common dates found when weighting multiple places
+        """
+        weighted, non_common = {}, {}
+        for period, changes in self._single.items():
+            self._weight_single(slice(*period), changes, weighted)
+
+        for period, changes in self._multiple.items():
+            self._weight_multiple(slice(*period), changes, weighted, non_common)
+
+        return weighted, non_common
+
+    def _weight_single(self, dates: slice, changes: List[Tuple[int, int, float]], weighted: dict) -> None:
+        """Weight the changes of a single place within a date period, keeping any values that are not numeric"""
+        db = self._database
+        date_values = db.dates[dates].tolist()
+        change_indexes = [change for change, _, _ in changes]
+        rows = np.array([row for _, row, _ in changes], dtype=np.int64)
+        weights = np.array([weight for _, _, weight in changes], dtype=np.float64)
+
+        for a in self._attribute_columns:
+            attr = db.attributes[a]
+            has_attribute = db.has_attribute[rows, a]
+            values, present, numeric = db.block(rows, a, dates)
+            values = (values * (weights / 100)[:, None]).tolist()
+            numeric = numeric.tolist()
+
+            for i in np.flatnonzero(has_attribute).tolist():
+                attr_values = weighted.setdefault(change_indexes[i], {}).setdefault(attr, {})
+                for d in np.flatnonzero(present[i]).tolist():
+                    attr_values[date_values[d]] = values[i][d] if numeric[i][d] else \
+                        db.text_value(int(rows[i]), a, dates.start + d)
+
+    def _weight_multiple(self, dates: slice, changes: List[Tuple[int, List[int], List[float], List[str]]],
+                         weighted: dict, non_common: dict) -> None:
+        """
+        Weight the changes of multiple places within a date period with a sparse matrix multiply, on the dates common
+        to all the places of each change, recording the dates that are not common
+        """
+        db = self._database
+        date_values = db.dates[dates]
+
+        # Each change is a row of the matrix, with the weights held in the order of the change's places so that the
+        # multiply sums the weighted values in the same order as summing them one by one
+        indptr = np.cumsum([0] + [len(rows) for _, rows, _, _ in changes])
+        sources, columns = np.unique(np.concatenate([rows for _, rows, _, _ in changes]), return_inverse=True)
+        columns = columns.reshape(-1)
+        shape = (len(changes), len(sources))
+
+        weights = np.concatenate([place_weights for _, _, place_weights, _ in changes]).astype(np.float64) / 100
+        weight_matrix = csr_matrix((weights, columns, indptr), shape=shape)
+        count_matrix = csr_matrix((np.ones(len(columns), dtype=np.int64), columns, indptr), shape=shape)
+        targets = np.diff(indptr)
+
+        for a in self._attribute_columns:
+            attr = db.attributes[a]
+            has_attribute = count_matrix @ db.has_attribute[sources, a].astype(np.int64)
+            values, present, numeric = db.block(sources, a, dates)
+            counts = count_matrix @ present.astype(np.int64)
+            numeric = count_matrix @ numeric.astype(np.int64)
+            values = weight_matrix @ values
+
+            for i, (change, _, _, weight_places) in enumerate(changes):
+                # Not all places will have the same attributes, in which case this attribute cannot be weighted
+                if has_attribute[i] != targets[i]:
+                    continue
+
+                # If we have any non_common dates, we can't use this date for weighting
+                non_common_dates = np.flatnonzero((counts[i] > 0) & (counts[i] != targets[i]))
+                if len(non_common_dates) > 0:
+                    non_common.setdefault(change, {})[attr] = {
+                        "Places": weight_places, "Target": int(targets[i]),
+                        "Dates": {int(date_values[d]): int(counts[i, d]) for d in non_common_dates}}
+
+                common = np.flatnonzero(counts[i] == targets[i])
+                attr_values = weighted.setdefault(change, {}).setdefault(attr, {})
+                for date, value, is_numeric in zip(date_values[common].tolist(), values[i, common].tolist(),
+                                                   (numeric[i, common] == targets[i]).tolist()):
+                    attr_values[date] = value if is_numeric else "NA"
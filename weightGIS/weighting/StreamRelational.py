@@ -0,0 +1,58 @@
+from weightGIS.weighting.StreamWeights import write_weights_line
+
+from typing import Dict, Iterable, List, Union
+from miscSupports import load_json
+from pathlib import Path
+import json
+
+
+class StreamedRelational:
+    def __init__(self, relational_path: Union[str, Path]):
+        """
+        A relational database written one place per line, as a .jsonl file from FormatRelational, that is read on
+        demand rather than loaded.
+
+        The file is scanned once to find the byte offset of each place's line and the attributes of every place, after
+        which only the places requested by load are read and parsed.
+        """
+        self.file_path = Path(relational_path)
+
+        self._offsets: Dict[str, int] = {}
+        attributes = set()
+        with open(self.file_path, "rb") as relational_file:
+            offset = 0
+            for line in relational_file:
+                if line.strip():
+                    for place, data in json.loads(line).items():
+                        self._offsets[place] = offset
+                        attributes.update(attr for attr, values in data.items() if isinstance(values, dict))
+                offset += len(line)
+
+        self.attributes = list(attributes)
+
+    def __repr__(self):
+        return f"StreamedRelational of {len(self._offsets)} places from {self.file_path.name}"
+
+    @property
+    def places(self) -> List[str]:
+        """The places within the database, in the order they were written"""
+        return list(self._offsets)
+
+    def load(self, places: Iterable[str]) -> dict:
+        """Read and parse the lines of the requested places, in the order they were written, returning them as a dict"""
+        database = {}
+        with open(self.file_path, "rb") as relational_file:
+            for place in sorted(set(places), key=self._offsets.__getitem__):
+                relational_file.seek(self._offsets[place])
+                database[place] = json.loads(relational_file.readline())[place]
+        return database
+
+
+def write_streamed_relational(relational_path: Union[str, Path], streamed_path: Union[str, Path]) -> None:
+    """
+    Rewrite a relational json database one place per line, as FormatRelational writes a streamed database, so it can
+    be read a batch of places at a time by StreamedRelational
+    """
+    with open(streamed_path, "w", encoding="utf-8") as streamed_file:
+        for place, data in load_json(relational_path).items():
+            write_weights_line(streamed_file, place, data)
@@ -0,0 +1,91 @@
+from miscSupports import load_json
+from typing import Iterator, List, TextIO, Tuple, Union
+from pathlib import Path
+import json
+import os
+
+
+def is_streamed(weights_path: Union[str, Path]) -> bool:
+    """Weights written one place per line are held in .jsonl files, rather than a single json dict in a .txt file"""
+    return Path(weights_path).suffix == ".jsonl"
+
+
+def iterate_weights(weights_path: Union[str, Path]) -> Iterator[Tuple[str, dict]]:
+    """
+    Yield each place and its weights from a weights file.
+
+    If the weights are streamed then each line is only parsed as it is reached, so only a single place is ever held in
+    memory. Otherwise the json dict is loaded and its items yielded.
+    """
+    if is_streamed(weights_path):
+        with open(weights_path, encoding="utf-8") as weights_file:
+            for line in weights_file:
+                if line.strip():
+                    yield from json.loads(line).items()
+    else:
+        yield from load_json(weights_path).items()
+
+
+def write_weights_line(weights_file: TextIO, place: str, weights: dict) -> None:
+    """Write a single place and its weights as a line of a streamed weights file"""
+    weights_file.write(json.dumps({place: weights}, ensure_ascii=False, sort_keys=True) + "\n")
+
+
+def write_streamed_json(streamed_path: Union[str, Path], places: List[str], write_directory: Union[str, Path],
+                        write_name: str) -> None:
+    """
+    Write the places of a streamed file, one per line in the order of places, as the single json dict write_json would
+    write of them to {write_name}.txt. Places are written in the sorted order write_json writes them in, by reading
+    each from the offset of its line, so only one place is ever held in memory.
+    """
+    with open(streamed_path, "rb") as streamed_file:
+        line_offsets = [0]
+        for line in streamed_file:
+            line_offsets.append(line_offsets[-1] + len(line))
+
+        with open(Path(write_directory, f"{write_name}.txt"), "w", encoding="utf-8") as json_file:
+            if len(places) == 0:
+                json_file.write("{}")
+                return
+
+            json_file.write("{\n")
+            for i, line_index in enumerate(sorted(range(len(places)), key=places.__getitem__)):
+                streamed_file.seek(line_offsets[line_index])
+                place_json = json.dumps(json.loads(streamed_file.readline()), ensure_ascii=False, indent=4,
+                                        sort_keys=True)
+
+                # Strip the braces around the place, leaving it as it is indented within the dict of every place
+                json_file.write((",\n" if i > 0 else "") + place_json[2:-2])
+            json_file.write("\n}")
+
+
+def rewrite_weights(weights_path: Union[str, Path], places: Iterator[Tuple[str, dict]]) -> None:
+    """
+    Rewrite a streamed weights file from an iterator of places and weights. The places may be read lazily from the file
+    being rewritten, as they are written to a temporary file which only replaces the original once complete. If the
+    places fail to be read, the original is left as it was.
+    """
+    temporary_path = Path(weights_path).with_suffix(".jsonl.tmp")
+    try:
+        with open(temporary_path, "w", encoding="utf-8") as weights_file:
+            for place, weights in places:
+                write_weights_line(weights_file, place, weights)
+        os.replace(temporary_path, weights_path)
+    finally:
+        temporary_path.unlink(missing_ok=True)
+
+
+def completed_places(weights_path: Union[str, Path]) -> set:
+    """
+    Return the places already written to a streamed weights file. If the last line was only partially written, because
+    a run failed whilst writing it, it is truncated from the file so that place can be written again.
+    """
+    weights_path = Path(weights_path)
+    if not weights_path.exists():
+        return set()
+
+    with open(weights_path, "rb+") as weights_file:
+        complete_length = sum(len(line) for line in weights_file if line.endswith(b"\n"))
+        weights_file.truncate(complete_length)
+
+    return {place for place, _ in iterate_weights(weights_path)}
@@ -1,71 +1,365 @@
-from miscSupports import load_json, write_json, flatten
+from weightGIS.weighting.ColumnarStore import ColumnarDatabase, ColumnarWeights, is_columnar
+from weightGIS.weighting.StreamWeights import is_streamed, write_streamed_json, write_weights_line
+from weightGIS.weighting.StreamRelational import StreamedRelational
+from weightGIS.weighting.SparseWeights import SparseWeights
+from weightGIS.Parallel import chunk_indexes, parallel_map
+
+from miscSupports import load_json, write_json
 from collections import Counter
 from pathlib import Path
+import multiprocessing
+import numpy as np
+import math
 
 
 # TODO: Refactor this
 class WeightExternal:
-    def __init__(self, external_data_path, weights_path, date_max, delimiter="__"):
+    def __init__(self, external_data_path, weights_path, date_max, delimiter="__", attributes=None, date_min=None,
+                 plan_directory=None):
+        """
+        Weight an external relational database with the weights by dates from AssignWeights.
+
+        Either may be a json file, or a columnar store from write_columnar_database / write_columnar_weights. When the
+        database is a columnar store it is memory mapped, and each place is weighted with array arithmetic over its
+        attributes and dates rather than by walking nested dicts.
+
+        The database may also be a .jsonl file with a place per line, from FormatRelational with stream=True. This is
+        never loaded, instead the places each batch of places needs are read for that batch alone and then evicted.
+
+        If attributes are given only these attributes are weighted, with the rest dropped from a json database as soon
+        as it is loaded and never read from a columnar one. If date_min is given, only dates where
+        date_min <= date < date_max are weighted, including those of places that are copied unchanged.
+
+        A weights json is compiled into a weight plan of the dates, periods and places of every change, which is cached
+        in plan_directory under the hash of the json, defaulting to a WeightPlans directory alongside it. Weighting
+        other databases against the same weights then loads the plan rather than compiling it again. A plan already
+        returned by weight_plan may be given as weights_path instead, so several databases can share one plan. A plan
+        is cached for each distinct weights json, and is only removed by prune_weight_plans.
+        """
 
         # Load the external data
         assert Path(external_data_path).exists(), "Path to external data is invalid"
         print(f"Loading data...")
-        self.database = load_json(external_data_path)
+        self._columnar = is_columnar(external_data_path)
+        self._streamed = is_streamed(external_data_path)
+        if self._columnar:
+            self.database = ColumnarDatabase.load(external_data_path)
+            places = self.database.places
+        elif self._streamed:
+            self._relational = StreamedRelational(external_data_path)
+            self.database = {}
+            places = self._relational.places
+        else:
+            self.database = load_json(external_data_path)
+            places = self.database.keys()
 
         # The delimiter to access GID and the end date for weighting
         self.delimiter = delimiter
         self._user_end_date = date_max
 
-        # Create a GID: Place lookup dict to aid extraction of data
-        self.searcher = {place.split(self.delimiter)[0]: place for place in self.database.keys()}
+        # Create a GID: Place lookup dict to aid extraction of data, of the row of the place for columnar databases
+        if self._columnar:
+            self.searcher = {place.split(self.delimiter)[0]: row for row, place in enumerate(places)}
+        else:
+            self.searcher = {place.split(self.delimiter)[0]: place for place in places}
 
-        # The unique attributes from all places
-        self.attributes = list(set([attr for place in self.database.keys() for attr in self.database[place].keys()
-                               if isinstance(self.database[place][attr], dict)]))
+        # The unique attributes from all places, or the subset of them requested
+        if self._columnar:
+            self.attributes = self.database.attributes
+        elif self._streamed:
+            self.attributes = self._relational.attributes
+        else:
+            self.attributes = list(set([attr for place in self.database.keys() for attr in self.database[place].keys()
+                                   if isinstance(self.database[place][attr], dict)]))
+        self._attribute_subset = attributes is not None
+        if self._attribute_subset:
+            self._select_attributes(attributes)
+        self._attribute_columns = self._set_attribute_columns()
+
+        # The window of dates to weight, if only part of the database is required, with its bounds as yyyymmdd strings
+        self._date_min = date_min
+        self._window = None if date_min is None else (str(date_min), str(date_max))
+
+        # The weight dates created via AssignWeights, as a weight plan loaded from the cache if it has been compiled
+        if isinstance(weights_path, ColumnarWeights):
+            self._weights = weights_path
+        else:
+            self._weights = self.weight_plan(weights_path, plan_directory)
 
-        # The weight dates created via AssignWeights
-        self._weights_dates = load_json(weights_path)
+        # Resolve every place of the weights to its database key once, and cache each place's attributes as
+        # {int(date): value} maps as they are first used, so weighting does not re-split names or convert dates
+        self._resolved = {}
+        self._date_maps = {}
+        if not self._columnar:
+            for place_name in self._weights.places + self._weights.weight_places:
+                self._resolve(place_name)
 
         # Output json's of the master weighting database as well as a non_common to aid finding weight errors
         self._master = {}
-        self._non_common = {place_name: {} for place_name in self._weights_dates}
+        self._non_common = {place_name: {} for place_name in self._weights.places}
 
-    def weight_external(self, write_path, write_name="Weighted"):
+    @staticmethod
+    def weight_plan(weights_path, plan_directory=None):
+        """
+        Load the weight plan of a weights json from the cache, compiling and caching it if it has not been already, or
+        load a columnar weights store as is
+        """
+        if is_columnar(weights_path):
+            return ColumnarWeights.load(weights_path)
+
+        plan_directory = Path(weights_path).parent / "WeightPlans" if plan_directory is None else plan_directory
+        return ColumnarWeights.cached(weights_path, plan_directory)
+
+    def weight_external(self, write_path, write_name="Weighted", sparse=False, workers=1, batch_size=1000,
+                        stream_output=False):
         """
         This will use all the places and weights from the weights by dates file, and use it to weight an external data
         source.
+
+        If sparse, the weights are compiled into a sparse matrix per date period, and each attribute weighted with a
+        matrix multiply per period. A json database is interned into columns first in order to do so.
+
+        With more than one worker the places are split into contiguous shards and weighted across a pool of forked
+        processes, which share the loaded database copy-on-write rather than being sent it. The weighted places and
+        non common dates of each shard are merged back in the order of the places, so the output is identical to
+        weighting them in a single process.
+
+        A streamed database is weighted batch_size places at a time, and each weighted place written out as its batch
+        completes rather than held until the end. The weighted places are then assembled, a place at a time, into the
+        same {write_name}.txt json as any other database. If stream_output they are instead left as the lines of
+        {write_name}.jsonl, which is only possible for a streamed database.
         """
-        for index, place_name in enumerate(self._weights_dates):
-            if index % 100 == 0:
-                print(f"Weighted {index} places up to {place_name}")
+        if sparse and self._streamed:
+            print("Warning: Streamed databases cannot be interned into columns, weighting them by walking their dicts")
+            sparse = False
 
-            # See how many changes exist for this place
-            dates_of_change = [date for date in self._weights_dates[place_name].keys()]
+        if sparse:
+            self._to_columnar()
 
-            # If there is only one date, we have no weighting to do as the place remains unchanged from its first state
-            if (len(dates_of_change) == 1) and self.extract_data(place_name):
-                self._master[place_name] = self.extract_data(place_name)
+        if workers > 1 and "fork" not in multiprocessing.get_all_start_methods():
+            print("Warning: Processes cannot be forked on this platform, weighting within a single process")
+            workers = 1
 
-            # Otherwise we need to weight the data, and potentially consider non-common dates across places
+        if stream_output and not self._streamed:
+            print("Warning: Only streamed databases are weighted to a streamed output, writing a json instead")
+
+        if self._streamed:
+            self._weight_streamed(write_path, write_name, workers, batch_size, stream_output)
+        else:
+            indexes = range(len(self._place_names()))
+            if workers > 1:
+                self._parallel_weight(indexes, sparse, workers)
             else:
-                self._master[place_name] = self._weight_place(place_name, dates_of_change)
+                self._weight(indexes, sparse)
+
+            # Write out the weighted data
+            print("Finished constructing weights - writing to file")
+            write_json(self._master, write_path, write_name)
 
-        # Write out the weighted data
-        print("Finished constructing weights - writing to file")
-        write_json(self._master, write_path, write_name)
+        self._write_non_common(write_path, write_name)
+
+    @staticmethod
+    def weight_streams(weight_externals, write_path, write_names, batch_size=1000, stream_output=False):
+        """
+        Weight several streamed databases against the same weight plan in a single walk of it, writing each weighted
+        database as {write_name}.txt of its name within write_names, or {write_name}.jsonl if stream_output. See
+        weight_external.
+
+        The plan is walked batch_size places at a time, with the database places each batch needs loaded from every
+        database together. The changes of each place, with the period, places and weights of each change, are read
+        from the plan once and applied to the entries of every database, so the output of each database is identical
+        to weighting it alone with weight_external.
+        """
+        assert len(weight_externals) == len(write_names), "Each database requires a write name"
+        assert all(external._streamed for external in weight_externals), \
+            "Only streamed databases are weighted together, weight others with weight_external"
+        weights = weight_externals[0]._weights
+        date_max = weight_externals[0]._user_end_date
+        assert all(external._weights is weights and external._user_end_date == date_max
+                   for external in weight_externals), "Databases weighted together must share a plan and date_max"
+
+        place_names = weights.places
+        weighted_files = [open(_streamed_path(write_path, write_name, stream_output), "w", encoding="utf-8")
+                          for write_name in write_names]
+        try:
+            for start in range(0, len(place_names), batch_size):
+                indexes = range(start, min(start + batch_size, len(place_names)))
+                batch_places = weight_externals[0]._batch_places(indexes)
+                for external in weight_externals:
+                    external._load_batch(batch_places)
+
+                for index in indexes:
+                    place_name = place_names[index]
+                    if index % 100 == 0:
+                        print(f"Weighted {index} places up to {place_name}")
+
+                    periods = weight_externals[0]._change_periods(index)
+                    for external, weighted_file in zip(weight_externals, weighted_files):
+                        write_weights_line(weighted_file, place_name, external._weighted_entry(place_name, periods))
+
+                # Evict the places of this batch
+                for external in weight_externals:
+                    external.database = {}
+                    external._date_maps = {}
+        finally:
+            for weighted_file in weighted_files:
+                weighted_file.close()
+
+        for external, write_name in zip(weight_externals, write_names):
+            _assemble_streamed(place_names, write_path, write_name, stream_output)
+            external._write_non_common(write_path, write_name)
+
+    def _write_non_common(self, write_path, write_name):
+        """Write out the non common dates of the places that had any, to aid finding weight errors"""
         if len(self._non_common.keys()) > 0:
             write_non_common = {key: value for key, value in self._non_common.items() if len(value) > 0}
             write_json(write_non_common, write_path, f"{write_name}_NonCommonDates")
 
+    def _weight_streamed(self, write_path, write_name, workers, batch_size, stream_output):
+        """
+        Weight the places of a streamed database in batches. The database places that each batch needs are loaded
+        before it is weighted and evicted after, with the batch's weighted places written out in order as it completes.
+        """
+        place_names = self._place_names()
+        with open(_streamed_path(write_path, write_name, stream_output), "w", encoding="utf-8") as weighted_file:
+            for start in range(0, len(place_names), batch_size):
+                indexes = range(start, min(start + batch_size, len(place_names)))
+                self._load_batch(self._batch_places(indexes))
+
+                if workers > 1:
+                    self._parallel_weight(indexes, False, workers)
+                else:
+                    self._weight(indexes, False)
+
+                for index in indexes:
+                    write_weights_line(weighted_file, place_names[index], self._master.pop(place_names[index]))
+
+                # Evict the places of this batch
+                self.database = {}
+                self._date_maps = {}
+
+        _assemble_streamed(place_names, write_path, write_name, stream_output)
+
+    def _batch_places(self, indexes):
+        """The places of the weights at indexes, and every place they are weighted from"""
+        place_names = self._place_names()
+
+        batch_places = set()
+        for index in indexes:
+            batch_places.add(place_names[index])
+            for change in self._weights.changes(index):
+                batch_places.update(self._weights.change_weights(change)[0])
+        return batch_places
+
+    def _load_batch(self, batch_places):
+        """Load the places of a streamed database needed to weight batch_places, and only those places"""
+        required = {self._resolve(place_name) for place_name in batch_places}
+        required.discard(None)
+
+        self.database = self._relational.load(required)
+        if self._attribute_subset:
+            self._strip_attributes()
+        self._date_maps = {}
+
+    def _place_names(self):
+        """The places of the weights, in the order they are written"""
+        return self._weights.places
+
+    def _weight(self, indexes, sparse):
+        """Weight the places at indexes within the places of the weights, adding them to master"""
+        if sparse:
+            self._weight_sparse(indexes)
+        elif self._columnar:
+            self._weight_columnar(indexes)
+        else:
+            self._weight_dicts(indexes)
+
+    def _parallel_weight(self, indexes, sparse, workers):
+        """
+        Weight contiguous shards of indexes across a pool of forked processes, merging the weighted places and non
+        common dates of each shard back into master and non common in the order of indexes
+        """
+        shards = chunk_indexes(indexes, workers)
+        shard_places = parallel_map(self, WeightExternal._weight_shard, [(shard, sparse) for shard in shards], workers,
+                                    fork=True)
+        for shard, weighted_places in zip(shards, shard_places):
+            print(f"Weighted {shard[-1] + 1} / {len(indexes)} places")
+            for place_name, place_dict, non_common in weighted_places:
+                self._master[place_name] = place_dict
+                self._non_common[place_name] = non_common
+
+    def _weight_shard(self, indexes, sparse):
+        """
+        Weight a shard of places within a worker process, returning each place's weighted data and non common dates
+        """
+        self._master = {}
+        self._weight(indexes, sparse)
+
+        place_names = self._place_names()
+        return [(place_names[index], self._master[place_names[index]], self._non_common[place_names[index]])
+                for index in indexes]
+
+    def _weight_dicts(self, indexes):
+        """Weight each place of a json database by walking its nested dicts"""
+        for index in indexes:
+            place_name = self._weights.places[index]
+            if index % 100 == 0:
+                print(f"Weighted {index} places up to {place_name}")
+
+            self._master[place_name] = self._weighted_entry(place_name, self._change_periods(index))
+
+    def _change_periods(self, index):
+        """The date min and max, weight places and weights of each change of the place at index of the weights"""
+        return [(*self._weights.period(change, self._user_end_date), *self._weights.change_weights(change))
+                for change in self._weights.changes(index)]
+
+    def _weighted_entry(self, place_name, periods):
+        """Weight a place of a json database from the periods of its changes, see _change_periods"""
+        # If there is only one date, we have no weighting to do as the place remains unchanged from its first state
+        data = self.extract_data(place_name)
+        if (len(periods) == 1) and data:
+            return self._window_entry(data)
+
+        # Otherwise we need to weight the data, and potentially consider non-common dates across places
+        else:
+            return self._weight_place(place_name, periods)
+
     def extract_data(self, place):
         """
         Check to see if the database contains a given place
         """
         try:
-            return self.database[self._search_name(place)]
+            if self._columnar:
+                return self.database.entry(self._search_name(place))
+
+            data_key = self._resolve(place)
+            return None if data_key is None else self.database[data_key]
         except KeyError:
             return None
 
+    def _resolve(self, place_name):
+        """Return the database key of a place, or None if it has no data, caching it for later lookups"""
+        try:
+            return self._resolved[place_name]
+        except KeyError:
+            data_key = self.searcher.get(place_name.split(self.delimiter)[0])
+            self._resolved[place_name] = data_key
+            return data_key
+
+    def _date_map(self, data_key, attr):
+        """
+        Return the {int(date): value} map of an attribute of a database entry, or None if the entry does not have the
+        attribute. Maps are cached, as the same place is often involved in the weights of several places.
+        """
+        try:
+            return self._date_maps[data_key, attr]
+        except KeyError:
+            data = self.database[data_key].get(attr)
+            date_map = None if data is None else {int(date): value for date, value in data.items()
+                                                  if self._in_window(date)}
+            self._date_maps[data_key, attr] = date_map
+            return date_map
+
     def _search_name(self, place_name):
         """
         Extract the key from a place_name, and use that to get the data key from the using this place_name as key in the
@@ -73,7 +367,7 @@ class WeightExternal:
         """
         return self.searcher[place_name.split(self.delimiter)[0]]
 
-    def _weight_place(self, place_name, dates_of_change):
+    def _weight_place(self, place_name, periods):
         """
         Use weights and dates from a combination of ConstructWeights and AssignWeights to create a weight value set for
         a given place.
@@ -90,8 +384,8 @@ class WeightExternal:
         :param place_name: The place we wish to construct weights for
         :type place_name: str
 
-        :param dates_of_change: The yyyymmdd dates of changes
-        :type dates_of_change: list
+        :param periods: The min and max dates, and the places and weights, of each change of this place
+        :type periods: list[tuple]
 
         :return: A dict of all the weighted values for all the attributes found for this place
         :rtype: dict
@@ -99,32 +393,19 @@ class WeightExternal:
         place_dict = {attr: {} for attr in self.attributes}
 
         # For each change that occurs in this place
-        for index, date in enumerate(dates_of_change, 1):
-
-            # Set the date min and max dates for the current date change
-            date_min, date_max = self._set_min_max_date(index, date, dates_of_change)
+        for date_min, date_max, weight_places, weights in periods:
 
             # If there is only one place for this change, then we just need to weight the values relevant to the dates
-            if len(self._weights_dates[place_name][date]) == 1:
-                self._weight_single(place_name, date, place_dict, date_min, date_max)
+            if len(weight_places) == 1:
+                self._weight_single(weight_places[0], weights[0], place_dict, date_min, date_max)
 
             # Otherwise we have to make sure all places, have all dates, and sum weighted values appropriately .
             else:
-                self._weight_multiple(place_name, date, place_dict, date_min, date_max)
+                self._weight_multiple(place_name, weight_places, weights, place_dict, date_min, date_max)
 
         return place_dict
 
-    def _set_min_max_date(self, index, date, dates_range):
-        """
-        If we have reached the last date provided, then set max date to be the max provided by the user, otherwise
-        create a time period from the current date and the next date
-        """
-        if index < len(dates_range):
-            return int(date), int(dates_range[index])
-        else:
-            return int(date), int(self._user_end_date)
-
-    def _weight_single(self, place_name, weight_date, place_dict, date_min, date_max):
+    def _weight_single(self, place_key, weight, place_dict, date_min, date_max):
         """
         Extract data from a single location and weight the values between a min and max date
 
@@ -132,63 +413,47 @@ class WeightExternal:
         can just weight the values of each attribute and append them to our place dict as long as the database contains
         information about this place.
 
-        :param place_name: The current name of the place we are constructing weights for
-        :type place_name: str
+        :param place_key: The place to weight the values of
+        :type place_key: str
 
-        :param weight_date: The current date of change to load weights from
-        :type weight_date: str
+        :param weight: The weight of the place
+        :type weight: float
 
         :param place_dict: The storage dict for all the data from this place which will be appended to the master json
         :type place_dict: dict
 
         :param date_min: The start date of this weight
-        :type date_min: str | int
+        :type date_min: int
 
         :param date_max: The end date of this weight
-        :param date_max: str | int
+        :param date_max: int
 
         :return: Nothing, append weight values per date with the date range to the place_dict then stop
         :rtype: None
         """
-        # Extract the place_names place key and weight for this place
-        place_key, weight = self._extract_weight_place(self._weights_dates[place_name][weight_date])
-
         # If the database contains information about this place
-        if self.extract_data(place_key):
+        data_key = self._resolve(place_key)
+        if data_key is not None and self.database[data_key]:
 
             # For each unique attribute
             for attr in self.attributes:
 
-                # Isolate the data from the database for this place's attribute
-                try:
-                    data = self.extract_data(place_key)[attr]
+                # Isolate the data from the database for this place's attribute, if the attribute doesn't exist for
+                # this place, pass
+                data = self._date_map(data_key, attr)
+                if data is None:
+                    continue
 
-                    # Assign the weight value for this date for this attribute to the place json database dict
-                    for date, value in data.items():
-                        if date_min <= int(date) < date_max:
-                            place_dict[attr][int(date)] = self.calculate_weight(value, weight)
-
-                # If the attribute doesn't exist for this place, pass
-                except KeyError:
-                    pass
+                # Assign the weight value for this date for this attribute to the place json database dict
+                attr_dict = place_dict[attr]
+                for date, value in data.items():
+                    if date_min <= date < date_max:
+                        attr_dict[date] = self.calculate_weight(value, weight)
 
         # Warn the user that we have failed to find a location, so it will be missing
         else:
             print(f"Warning: No data found for {place_key}")
 
-    @staticmethod
-    def _extract_weight_place(date_data):
-        """
-        Extract the places and weights for a given date for a given place in weight_dates
-        """
-        weight_places = [place for place in date_data.keys()]
-        weight_list = [weight for weight in date_data.values()]
-
-        if (len(weight_places) == 1) and (len(weight_list) == 1):
-            return weight_places[0], weight_list[0]
-        else:
-            return weight_places, weight_list
-
     @staticmethod
     def calculate_weight(value, weight):
         """
@@ -205,7 +470,7 @@ class WeightExternal:
         else:
             return value * (weight / 100)
 
-    def _weight_multiple(self, place_name, weight_date, place_dict, date_min, date_max):
+    def _weight_multiple(self, place_name, weight_places, weights, place_dict, date_min, date_max):
         """
         weight a places values based on weights of multiple places
 
@@ -215,59 +480,51 @@ class WeightExternal:
         :param place_name: The current name of the place we are constructing weights for
         :type place_name: str
 
-        :param weight_date: The current date of change to load weights from
-        :type weight_date: str
+        :param weight_places: The places involved in this change
+        :type weight_places: list[str]
+
+        :param weights: The weight of each place
+        :type weights: list[float]
 
         :param place_dict: The storage dict for all the data from this place which will be appended to the master json
         :type place_dict: dict
 
         :param date_min: The start date of this weight
-        :type date_min: str | int
+        :type date_min: int
 
         :param date_max: The end date of this weight
-        :param date_max: str | int
+        :param date_max: int
 
         :return: Nothing, append weight values per date with the date range to the place_dict then stop
         :rtype: None
-
-        :raise AssertionError: If the len of validate dates is not equal to the number of places after trying to pass
-            only places within common attributes
         """
 
-        # Extract the places and weights involved in this change
-        weight_places, weights = self._extract_weight_place(self._weights_dates[place_name][weight_date])
-
         # Determine if we have data for each place
-        all_valid = [self.extract_data(place) for place in weight_places if self.extract_data(place)]
+        data_keys = [self._resolve(place) for place in weight_places]
+        all_valid = [data_key for data_key in data_keys if data_key is not None and self.database[data_key]]
 
         # If we have data for both places
         if len(all_valid) == len(weight_places):
 
             for attr in self.attributes:
-                try:
-                    # Not all places will have the same attributes, This should be picked up by a KeyError but if not
-                    # the assertion should catch it
-                    validate_dates = [self.extract_data(place)[attr] for place in weight_places]
-                    assert len(validate_dates) == len(weight_places), "Critical Error: KeyError failed to catch " \
-                                                                      "missing attribute"
+                # Not all places will have the same attributes, in which case this attribute cannot be weighted
+                date_maps = [self._date_map(data_key, attr) for data_key in data_keys]
+                if any(date_map is None for date_map in date_maps):
+                    continue
 
-                    # Extract all the common dates
-                    dates_list = self._extract_usable_dates(attr, date_min, date_max, weight_places, place_name)
+                # Extract all the common dates
+                dates_list = self._extract_usable_dates(attr, date_min, date_max, date_maps, weight_places, place_name)
 
-                    # Use these dates to create a set of weight values
-                    weight_values = [self._weight_summation(date, attr, weight_places, weights) for date in dates_list]
-
-                    # Assign the weighted values to the dates
-                    for date, value in zip(dates_list, weight_values):
-                        place_dict[attr][int(date)] = value
-                except KeyError:
-                    pass
+                # Use these dates to create a set of weight values, and assign the weighted values to the dates
+                attr_dict = place_dict[attr]
+                for date in dates_list:
+                    attr_dict[date] = self._weight_summation(date, date_maps, weights)
 
         else:
             print(f"Warning: Found {len(all_valid)} out of {len(weight_places)} places for {place_name}'s weighted "
-                  f"places of: {weight_places}\n       : Data from {weight_date}-{date_max} will be dropped\n")
+                  f"places of: {weight_places}\n       : Data from {date_min}-{date_max} will be dropped\n")
 
-    def _extract_usable_dates(self, attr, date_min, date_max, weight_places, place_name):
+    def _extract_usable_dates(self, attr, date_min, date_max, date_maps, weight_places, place_name):
         """
         Determine if all required dates are present and return the common dates between places. If the location does not
         contain common dates,  save the location date errors to a separate json
@@ -286,6 +543,9 @@ class WeightExternal:
         :param date_max: The end date of this weight
         :param date_max: str | int
 
+        :param date_maps: The {date: value} map of this attribute for each of the weight places
+        :type date_maps: list[dict]
+
         :param weight_places: The places that are involved in weighting for this place between date_min and date_max
         :type weight_places: list
 
@@ -296,11 +556,8 @@ class WeightExternal:
         :rtype: list
         """
 
-        # Isolate all the dates for all the weights places in place_list
-        dates_list = flatten([list(self.extract_data(place)[attr].keys()) for place in weight_places])
-
-        # Keep the dates within the time range we are looking for
-        dates_list = [int(date) for date in dates_list if date_min <= int(date) < date_max]
+        # Isolate all the dates for all the weights places, keeping the dates within the time range we are looking for
+        dates_list = [date for date_map in date_maps for date in date_map if date_min <= date < date_max]
 
         # Count each occurrence of a date to insure we have the same number in all places
         dates_dict = Counter(dates_list)
@@ -314,15 +571,15 @@ class WeightExternal:
                                                   "Dates": {d: dates_dict[d] for d in non_common_dates}}
 
         # Return common dates list
-        return sorted([date for date in dates_dict if date not in non_common_dates])
+        return sorted([date for date in dates_dict if dates_dict[date] == len(weight_places)])
 
-    def _weight_summation(self, date, attr, place_list, weights):
+    def _weight_summation(self, date, date_maps, weights):
         """
         Create a summed value from all the weights of the places
         """
 
         # Isolate the raw value from each place
-        values = [self.extract_data(place)[attr][str(date)] for place in place_list]
+        values = [date_map[date] for date_map in date_maps]
 
         # Weight these values
         weighted_values = [self.calculate_weight(value, weight) for value, weight in zip(values, weights)]
@@ -332,3 +589,279 @@ class WeightExternal:
             return sum(weighted_values)
         else:
             return "NA"
+
+    def _weight_columnar(self, indexes):
+        """
+        Weight each place of a columnar database. Each change of a place is weighted across all of the dates within it
+        at once, with the same results as weighting the nested dicts of a json database.
+        """
+        for index in indexes:
+            place_name = self._weights.places[index]
+            if index % 100 == 0:
+                print(f"Weighted {index} places up to {place_name}")
+
+            changes = self._weights.changes(index)
+
+            # If there is only one date, we have no weighting to do as the place remains unchanged from its first state
+            if (len(changes) == 1) and self._search_row(place_name) is not None:
+                self._master[place_name] = self._columnar_entry(place_name)
+
+            # Otherwise we need to weight the data, and potentially consider non-common dates across places
+            else:
+                self._master[place_name] = self._weight_place_columnar(place_name, changes)
+
+    def _select_attributes(self, attributes):
+        """
+        Limit the attributes to weight to those requested, warning of any that do not exist. The attributes that are not
+        required are removed from a json database so they are neither held nor weighted.
+        """
+        missing = [attr for attr in attributes if attr not in self.attributes]
+        if len(missing) > 0:
+            print(f"Warning: The following attributes were not found in the database: {missing}")
+        self.attributes = [attr for attr in self.attributes if attr in attributes]
+
+        if not self._columnar:
+            self._strip_attributes()
+
+    def _strip_attributes(self):
+        """Remove the attributes that are not weighted from the places of a json database"""
+        selected = set(self.attributes)
+        for place, data in self.database.items():
+            self.database[place] = {key: value for key, value in data.items()
+                                    if not isinstance(value, dict) or key in selected}
+
+    def _set_attribute_columns(self):
+        """The index of each attribute to weight within the attributes of a columnar database"""
+        if not self._columnar:
+            return None
+        attribute_index = {attr: index for index, attr in enumerate(self.database.attributes)}
+        return [attribute_index[attr] for attr in self.attributes]
+
+    def _in_window(self, date):
+        """
+        True if a yyyymmdd date string is within the window of dates to weight, or if no window was set. Dates as wide
+        as the window's bounds are compared as strings, so only dates of another width are converted to int.
+        """
+        if self._window is None:
+            return True
+
+        window_min, window_max = self._window
+        if len(date) == len(window_min) == len(window_max):
+            return window_min <= date < window_max
+        return self._date_min <= int(date) < self._user_end_date
+
+    def _window_entry(self, data):
+        """Limit the attributes of a database entry, of a place copied unchanged, to the window of dates to weight"""
+        if self._date_min is None:
+            return data
+        return {key: {date: value for date, value in value.items() if self._in_window(date)}
+                if isinstance(value, dict) else value for key, value in data.items()}
+
+    def _date_slice(self, date_min, date_max):
+        """The slice of a columnar database's dates where date_min <= date < date_max, within the window"""
+        if self._date_min is not None:
+            date_min, date_max = max(date_min, self._date_min), min(date_max, self._user_end_date)
+        return self.database.date_slice(date_min, date_max)
+
+    def _to_columnar(self):
+        """Intern a loaded json database into columns, so it can be weighted as a columnar database"""
+        if self._columnar:
+            return
+
+        self.database = ColumnarDatabase.from_relational(self.database)
+        self.searcher = {place.split(self.delimiter)[0]: row for row, place in enumerate(self.database.places)}
+        self._columnar = True
+        self._attribute_columns = self._set_attribute_columns()
+
+    def _weight_sparse(self, indexes):
+        """
+        Weight the places of a columnar database with SparseWeights. Places with only a single date are unchanged from
+        their first state so are copied as they are, and the weighted values and non common dates of the rest are
+        assembled in the order of their changes.
+        """
+        to_weight = []
+        for index in indexes:
+            place_name = self._weights.places[index]
+            if len(self._weights.changes(index)) == 1 and self._search_row(place_name) is not None:
+                self._master[place_name] = self._columnar_entry(place_name)
+            else:
+                to_weight.append(index)
+
+        print(f"Compiling weights for {len(to_weight)} places")
+        weighted, non_common = SparseWeights(self._weights, self.database, self._search_row, self._user_end_date,
+                                             to_weight, self._attribute_columns, self._date_slice).weight()
+
+        for index in to_weight:
+            place_name = self._weights.places[index]
+            place_dict = {attr: {} for attr in self.attributes}
+            for change in self._weights.changes(index):
+                for attr, values in weighted.get(change, {}).items():
+                    place_dict[attr].update(values)
+                self._non_common[place_name].update(non_common.get(change, {}))
+
+            self._master[place_name] = place_dict
+
+    def _columnar_entry(self, place_name):
+        """Rebuild the entry of a place copied unchanged from a columnar database, of the attributes and dates used"""
+        dates = self._date_slice(-math.inf, math.inf) if self._date_min is not None else None
+        return self.database.entry(self._search_row(place_name), self._attribute_columns, dates)
+
+    def _search_row(self, place_name):
+        """Return the row of a place in the columnar database, or None if it has no data"""
+        row = self.searcher.get(place_name.split(self.delimiter)[0])
+        if row is None or not self.database.populated[row]:
+            return None
+        return row
+
+    def _weight_place_columnar(self, place_name, changes):
+        """
+        Use the weights of each change of a place to create a weight value set for a given place, from a columnar
+        database. See _weight_place.
+
+        :param place_name: The place we wish to construct weights for
+        :type place_name: str
+
+        :param changes: The indexes of the changes of this place within the columnar weights
+        :type changes: range
+
+        :return: A dict of all the weighted values for all the attributes found for this place
+        :rtype: dict
+        """
+        place_dict = {attr: {} for attr in self.attributes}
+
+        # For each change that occurs in this place
+        for change in changes:
+
+            # Set the slice of the date axis for the current date change
+            date_min, date_max = self._weights.period(change, self._user_end_date)
+            dates = self._date_slice(date_min, date_max)
+
+            weight_places, weights = self._weights.change_weights(change)
+            if len(weight_places) == 1:
+                self._weight_single_columnar(weight_places[0], weights[0], place_dict, dates)
+            else:
+                self._weight_multiple_columnar(place_name, weight_places, weights, place_dict, dates, date_min,
+                                               date_max)
+
+        return place_dict
+
+    def _weight_single_columnar(self, place_key, weight, place_dict, dates):
+        """
+        Weight the values of every attribute of a single place within a slice of the date axis. See _weight_single.
+
+        :param place_key: The place to weight the values of
+        :type place_key: str
+
+        :param weight: The weight of the place
+        :type weight: float
+
+        :param place_dict: The storage dict for all the data from this place which will be appended to the master json
+        :type place_dict: dict
+
+        :param dates: The slice of the date axis for this change
+        :type dates: slice
+
+        :return: Nothing, append weight values per date with the date range to the place_dict then stop
+        :rtype: None
+        """
+        row = self._search_row(place_key)
+        if row is None:
+            print(f"Warning: No data found for {place_key}")
+            return
+
+        date_values = self.database.dates[dates].tolist()
+        for attr, a in zip(self.attributes, self._attribute_columns):
+            if not self.database.has_attribute[row, a]:
+                continue
+
+            values, present, numeric = self.database.block([row], a, dates)
+            weighted = (values[0] * (weight / 100)).tolist()
+            numeric = numeric[0].tolist()
+
+            for d in np.flatnonzero(present[0]).tolist():
+                place_dict[attr][date_values[d]] = weighted[d] if numeric[d] else \
+                    self.database.text_value(row, a, dates.start + d)
+
+    def _weight_multiple_columnar(self, place_name, weight_places, weights, place_dict, dates, date_min, date_max):
+        """
+        Weight and sum the values of every attribute of multiple places within a slice of the date axis, on the dates
+        common to all of the places. See _weight_multiple and _extract_usable_dates.
+
+        :param place_name: The current name of the place we are constructing weights for
+        :type place_name: str
+
+        :param weight_places: The places involved in this change
+        :type weight_places: list[str]
+
+        :param weights: The weight of each place
+        :type weights: list[float]
+
+        :param place_dict: The storage dict for all the data from this place which will be appended to the master json
+        :type place_dict: dict
+
+        :param dates: The slice of the date axis for this change
+        :type dates: slice
+
+        :param date_min: The start date of this weight
+        :type date_min: int
+
+        :param date_max: The end date of this weight
+        :param date_max: int
+
+        :return: Nothing, append weight values per date with the date range to the place_dict then stop
+        :rtype: None
+        """
+        # Determine if we have data for each place
+        rows = [self._search_row(place) for place in weight_places]
+        all_valid = [row for row in rows if row is not None]
+        if len(all_valid) != len(weight_places):
+            print(f"Warning: Found {len(all_valid)} out of {len(weight_places)} places for {place_name}'s weighted "
+                  f"places of: {weight_places}\n       : Data from {date_min}-{date_max} will be dropped\n")
+            return
+
+        date_values = self.database.dates[dates]
+        for attr, a in zip(self.attributes, self._attribute_columns):
+            # Not all places will have the same attributes, in which case this attribute cannot be weighted
+            if not self.database.has_attribute[rows, a].all():
+                continue
+
+            # Count each occurrence of a date to insure we have the same number in all places
+            values, present, numeric = self.database.block(rows, a, dates)
+            counts = present.sum(axis=0)
+
+            # If we have any non_common dates, we can't use this date for weighting, write out this information for
+            # users so they can fix their raw data
+            non_common = np.flatnonzero((counts > 0) & (counts != len(rows)))
+            if len(non_common) > 0:
+                self._non_common[place_name][attr] = {
+                    "Places": weight_places, "Target": len(weight_places),
+                    "Dates": {int(date_values[d]): int(counts[d]) for d in non_common}}
+
+            # Sum the weighted values of each place in turn on the common dates, which are NA if any are not numeric
+            common = np.flatnonzero(counts == len(rows))
+            values = values[:, common]
+            weighted_values = np.zeros(len(common))
+            for place_values, weight in zip(values, weights):
+                weighted_values = weighted_values + place_values * (weight / 100)
+            numeric = numeric[:, common].all(axis=0)
+
+            for date, value, is_numeric in zip(date_values[common].tolist(), weighted_values.tolist(),
+                                               numeric.tolist()):
+                place_dict[attr][date] = value if is_numeric else "NA"
+
+
+def _streamed_path(write_path, write_name, stream_output):
+    """The file weighted places are streamed to, which is temporary unless the output is to remain streamed"""
+    return Path(write_path, f"{write_name}.jsonl" if stream_output else f"{write_name}.jsonl.tmp")
+
+
+def _assemble_streamed(place_names, write_path, write_name, stream_output):
+    """Assemble the weighted places streamed to a temporary file into a json, unless the output is to remain streamed"""
+    if stream_output:
+        return
+
+    print("Finished constructing weights - writing to file")
+    streamed_path = _streamed_path(write_path, write_name, stream_output)
+    write_streamed_json(streamed_path, place_names, write_path, write_name)
+    streamed_path.unlink()
+